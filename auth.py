@@ -22,16 +22,12 @@ def register_user(users_collection, generate_user_id_func):
                 st.error("Email already exists. Please login.")
                 return None, None
             
-            # Pass the users_collection to the function
-            user_id = generate_user_id_func(users_collection)
-            
-            from datetime import datetime
-            users_collection.insert_one({
-                "user_id": user_id,
-                "username": username,
-                "email": email,
-                "created_at": datetime.now()
-            })
+            # The unique email index catches a registration racing this one
+            from user_ids import insert_user
+            user_id = insert_user(users_collection, username, email, generate_user_id_func)
+            if user_id is None:
+                st.error("Email already exists. Please login.")
+                return None, None
             
             from database import get_user_uploads_dir
             user_uploads_dir = get_user_uploads_dir(user_id)
@@ -54,7 +50,8 @@ def login_user(users_collection):
                 st.error("Both fields are required!")
                 return None, None
             
-            user = users_collection.find_one({"email": email, "user_id": user_id_input})
+            from user_profiles import find_login_profile
+            user = find_login_profile(users_collection, email, user_id_input)
             if not user:
                 st.error("Email or User ID not found!")
                 return None, None
@@ -0,0 +1,65 @@
+"""Measure chunking throughput on India.txt scaled up to a target size.
+
+Usage: python benchmark_chunking.py [--size-mb 100] [--unit chars|tokens]
+"""
+import argparse
+import re
+import time
+
+from chunking import Chunker
+
+SEGMENT_SIZE = 64 * 1024
+
+def build_corpus(size_mb, source="India.txt"):
+    with open(source, "r", encoding="utf-8") as f:
+        text = f.read()
+    repeats = max(1, (size_mb * 1024 * 1024) // len(text.encode("utf-8")))
+    return text * repeats
+
+def iter_segments(corpus):
+    for start in range(0, len(corpus), SEGMENT_SIZE):
+        yield {"text": corpus[start:start + SEGMENT_SIZE]}
+
+def legacy_chunks(content):
+    """The regex splitter previously inlined in process_files_to_collection"""
+    sentences = re.split(r'(?<=[.!?]) +', content)
+    chunks = []
+    current_chunk = ""
+    for sentence in sentences:
+        if len(current_chunk) + len(sentence) < 800:
+            current_chunk += sentence + " "
+        else:
+            chunks.append(current_chunk.strip())
+            current_chunk = sentence + " "
+    if current_chunk:
+        chunks.append(current_chunk.strip())
+    return chunks
+
+def report(name, seconds, size_mb, count):
+    print(f"{name:<28} {seconds:8.2f}s {size_mb / seconds:8.1f} MB/s {count:>10} chunks")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--size-mb", type=int, default=100)
+    parser.add_argument("--unit", choices=["chars", "tokens"], default="chars")
+    parser.add_argument("--chunk-size", type=int, default=800)
+    parser.add_argument("--overlap", type=int, default=0)
+    parser.add_argument("--skip-legacy", action="store_true")
+    args = parser.parse_args()
+    
+    corpus = build_corpus(args.size_mb)
+    size_mb = len(corpus.encode("utf-8")) / (1024 * 1024)
+    print(f"Corpus: {size_mb:.1f} MB")
+    
+    chunker = Chunker(chunk_size=args.chunk_size, overlap=args.overlap, unit=args.unit)
+    start = time.perf_counter()
+    count = sum(1 for _ in chunker.iter_chunks(iter_segments(corpus)))
+    report(f"Chunker ({chunker.signature})", time.perf_counter() - start, size_mb, count)
+    
+    if not args.skip_legacy:
+        start = time.perf_counter()
+        count = len(legacy_chunks(corpus))
+        report("legacy regex splitter", time.perf_counter() - start, size_mb, count)
+
+if __name__ == "__main__":
+    main()
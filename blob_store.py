@@ -0,0 +1,225 @@
+import os
+import json
+import shutil
+import hashlib
+import logging
+import tempfile
+import threading
+from pathlib import Path
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+
+from file_lock import FileLock
+
+BLOB_STORE_DIR = os.getenv("BLOB_STORE_DIR", "./uploads/blobs")
+WRITE_CHUNK_SIZE = 1024 * 1024
+UPLOAD_WORKERS = int(os.getenv("UPLOAD_WORKERS", 2))
+
+logger = logging.getLogger(__name__)
+
+_refs_lock = threading.Lock()
+_executor = None
+_executor_lock = threading.Lock()
+
+@contextmanager
+def _store_lock():
+    """Serialise blob commits, links, reference files and collection.
+    
+    The CLI and the app are separate processes sharing the store, so a
+    file lock is held on top of the in-process lock.
+    """
+    root = Path(BLOB_STORE_DIR)
+    root.mkdir(parents=True, exist_ok=True)
+    with _refs_lock, FileLock(root / ".lock"):
+        yield
+
+def blob_path(digest):
+    return Path(BLOB_STORE_DIR) / digest[:2] / digest
+
+def _refs_path(user_id):
+    return Path(BLOB_STORE_DIR) / "refs" / f"user_{user_id}.json"
+
+def _user_dir(user_id):
+    from database import get_user_uploads_dir
+    return get_user_uploads_dir(user_id)
+
+def load_refs(user_id):
+    """Return the user's ``{file name: sha256}`` references"""
+    try:
+        with open(_refs_path(user_id), "r", encoding="utf-8") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+def _save_refs(user_id, refs):
+    path = _refs_path(user_id)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_suffix(".tmp")
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(refs, f)
+    os.replace(tmp_path, path)
+
+def _write_temp(stream):
+    """Copy a binary file object to a temporary file in WRITE_CHUNK_SIZE
+    pieces, hashing it on the way. Returns ``(sha256, temp path)``.
+    """
+    tmp_dir = Path(BLOB_STORE_DIR) / "tmp"
+    tmp_dir.mkdir(parents=True, exist_ok=True)
+    digest = hashlib.sha256()
+    with tempfile.NamedTemporaryFile(dir=tmp_dir, delete=False) as tmp:
+        for block in iter(lambda: stream.read(WRITE_CHUNK_SIZE), b""):
+            digest.update(block)
+            tmp.write(block)
+    return digest.hexdigest(), tmp.name
+
+def _commit_blob(digest, tmp_path):
+    """Make ``tmp_path`` the blob unless that content is stored already.
+    
+    Callers hold ``_store_lock``, so ``_collect`` cannot remove the blob
+    between this check and the link that references it.
+    """
+    path = blob_path(digest)
+    if path.exists():
+        os.remove(tmp_path)
+    else:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        os.replace(tmp_path, path)
+
+def _link(source, target):
+    try:
+        os.link(source, target)
+    except OSError:
+        # Filesystems without hard links get a private copy instead
+        shutil.copyfile(source, target)
+
+def add_reference(user_id, name, digest, tmp_path=None):
+    """Expose blob ``digest`` in the user's uploads as ``name``.
+    
+    If the user already has this content under some name, that path is
+    returned instead of adding a second copy. Otherwise the blob is hard
+    linked into the user's uploads directory under a free name, so the
+    rest of the app keeps working with plain file paths. ``tmp_path``,
+    a freshly written copy of the content, is committed to the store
+    under the same lock as the link. Returns ``(path, is_new)``.
+    """
+    user_dir = _user_dir(user_id)
+    with _store_lock():
+        if tmp_path is not None:
+            _commit_blob(digest, tmp_path)
+        refs = load_refs(user_id)
+        for existing_name, existing_digest in refs.items():
+            if existing_digest == digest and (user_dir / existing_name).exists():
+                return str(user_dir / existing_name), False
+        
+        target = user_dir / name
+        counter = 1
+        while target.exists() or target.name in refs:
+            stem, ext = os.path.splitext(name)
+            target = user_dir / f"{stem}_{counter}{ext}"
+            counter += 1
+        
+        _link(blob_path(digest), target)
+        refs[target.name] = digest
+        _save_refs(user_id, refs)
+    return str(target), True
+
+def store_upload(user_id, name, stream):
+    """Store one upload and reference it for the user; returns ``(path, is_new)``"""
+    digest, tmp_path = _write_temp(stream)
+    return add_reference(user_id, os.path.basename(name), digest, tmp_path)
+
+def store_file(user_id, file_path):
+    """Store a file from disk (CLI uploads); returns ``(path, is_new)``"""
+    with open(file_path, "rb") as f:
+        return store_upload(user_id, file_path, f)
+
+def _get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=UPLOAD_WORKERS, thread_name_prefix="upload")
+        return _executor
+
+def store_uploads_async(user_id, uploads, on_stored=None):
+    """Store ``(name, file object)`` uploads off the calling thread.
+    
+    Once every upload has been tried, ``on_stored`` is called with one
+    ``(path, error)`` pair per upload, in order: the stored path
+    (duplicates included) and None, or None and the error message.
+    Returns the Future.
+    """
+    def store_all():
+        results = []
+        for name, stream in uploads:
+            try:
+                path, _ = store_upload(user_id, name, stream)
+                results.append((path, None))
+            except Exception as e:
+                logger.exception("Failed to store upload %s", name)
+                results.append((None, str(e) or type(e).__name__))
+        if on_stored is not None:
+            on_stored(results)
+        return results
+    
+    return _get_executor().submit(store_all)
+
+def release(user_id, file_path):
+    """Drop the user's reference to ``file_path`` and the file itself.
+    
+    The blob and its parse cache are deleted once no user links to it.
+    """
+    name = os.path.basename(file_path)
+    with _store_lock():
+        refs = load_refs(user_id)
+        digest = refs.pop(name, None)
+        if digest is not None:
+            _save_refs(user_id, refs)
+        
+        if os.path.exists(file_path):
+            os.remove(file_path)
+        if digest is not None:
+            _collect(digest)
+
+def release_all(user_id):
+    """Drop every reference a user holds, removing their uploads"""
+    with _store_lock():
+        refs = load_refs(user_id)
+        _save_refs(user_id, {})
+        for file_path in _user_dir(user_id).glob("*"):
+            if file_path.is_file():
+                file_path.unlink()
+        for digest in set(refs.values()):
+            _collect(digest)
+
+def _collect(digest):
+    path = blob_path(digest)
+    try:
+        # The store's own entry is the only link left
+        if path.stat().st_nlink > 1:
+            return
+        path.unlink()
+    except FileNotFoundError:
+        pass
+    for parsed in (Path(BLOB_STORE_DIR) / "parsed").glob(f"{digest}.*"):
+        parsed.unlink()
+
+def _parsed_path(digest, signature):
+    key = hashlib.sha256(signature.encode("utf-8")).hexdigest()[:16]
+    return Path(BLOB_STORE_DIR) / "parsed" / f"{digest}.{key}.json"
+
+def load_parsed(digest, signature):
+    """Return chunks cached for this content and chunker, or None"""
+    try:
+        with open(_parsed_path(digest, signature), "r", encoding="utf-8") as f:
+            return [tuple(chunk) for chunk in json.load(f)]
+    except (FileNotFoundError, ValueError):
+        return None
+
+def save_parsed(digest, signature, chunks):
+    """Cache a file's parsed chunks so identical content is parsed once"""
+    path = _parsed_path(digest, signature)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_suffix(f".{os.getpid()}.{threading.get_ident()}.tmp")
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(chunks, f)
+    os.replace(tmp_path, path)
\ No newline at end of file
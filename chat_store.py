@@ -0,0 +1,138 @@
+import time
+import atexit
+import logging
+import queue
+import threading
+from datetime import datetime
+
+from bson import ObjectId
+
+logger = logging.getLogger(__name__)
+
+RETRY_DELAY = 1.0
+MAX_RETRY_DELAY = 60.0
+
+_queue = queue.Queue()
+_worker = None
+_worker_lock = threading.Lock()
+
+def _chat_fields(user_id, title, mode):
+    return {"user_id": user_id, "title": title, "timestamp": datetime.now(), "mode": mode}
+
+def _numbered(messages, first_seq):
+    return [dict(message, seq=first_seq + i) for i, message in enumerate(messages)]
+
+def start_chat(collection, user_id, title, mode, messages):
+    """Queue the creation of a new chat document and return its ``_id``.
+
+    The ID is generated client-side so later appends can be queued right
+    away, before the chat has reached MongoDB.
+    """
+    chat_id = ObjectId()
+    _enqueue(collection, chat_id, _chat_fields(user_id, title, mode), _numbered(messages, 0))
+    return chat_id
+
+def append_messages(collection, chat_id, user_id, title, mode, messages, first_seq):
+    """Queue new messages for a chat; ``first_seq`` is the first one's position.
+
+    The chat's own fields travel with the messages, so the write creates
+    the document if the one that should have created it failed.
+    """
+    if messages:
+        _enqueue(collection, chat_id, _chat_fields(user_id, title, mode), _numbered(messages, first_seq))
+
+def save_new_messages(collection, chat_id, user_id, title, mode, messages, saved_count):
+    """Persist ``messages[saved_count:]``, creating the chat if needed.
+
+    Returns ``(chat_id, saved_count)`` to carry into the next turn, so each
+    turn writes only the messages it added.
+    """
+    new_messages = messages[saved_count:]
+    if not new_messages:
+        return chat_id, saved_count
+    if chat_id is None:
+        chat_id = start_chat(collection, user_id, title, mode, new_messages)
+    else:
+        append_messages(collection, chat_id, user_id, title, mode, new_messages, saved_count)
+    return chat_id, len(messages)
+
+def flush(timeout=None):
+    """Block until every queued write has been saved, or ``timeout`` passes"""
+    if _worker is None:
+        return
+    done = threading.Event()
+    _queue.put(done)
+    done.wait(timeout)
+
+def _enqueue(collection, chat_id, fields, messages):
+    global _worker
+    with _worker_lock:
+        if _worker is None or not _worker.is_alive():
+            _worker = threading.Thread(target=_run, name="chat-store", daemon=True)
+            _worker.start()
+    _queue.put((collection, chat_id, fields, messages))
+
+def _run():
+    # Chats with unsaved messages, in the order they were queued
+    pending = {}
+    waiters = []
+    while True:
+        timeout = None
+        if pending:
+            timeout = max(min(entry["retry_at"] for entry in pending.values()) - time.monotonic(), 0)
+        try:
+            ops = [_queue.get(timeout=timeout)]
+        except queue.Empty:
+            ops = []
+        # Drain whatever else is waiting so bursts become one write per chat
+        while True:
+            try:
+                ops.append(_queue.get_nowait())
+            except queue.Empty:
+                break
+        
+        for op in ops:
+            if isinstance(op, threading.Event):
+                waiters.append(op)
+                continue
+            collection, chat_id, fields, messages = op
+            entry = pending.setdefault(chat_id, {
+                "collection": collection, "fields": fields, "messages": [],
+                "attempts": 0, "retry_at": 0.0
+            })
+            # Messages queued behind a failed write wait for its retry
+            entry["messages"].extend(messages)
+        
+        _write(pending)
+        if not pending:
+            for waiter in waiters:
+                waiter.set()
+            waiters = []
+
+def _write(pending):
+    """Write every chat in ``pending`` that is due; failed ones stay for a retry"""
+    now = time.monotonic()
+    for chat_id, entry in list(pending.items()):
+        if entry["retry_at"] > now:
+            continue
+        # One upsert both creates new chats and appends to existing ones.
+        # Messages carry their position (``seq``), so $addToSet skips any
+        # that an earlier attempt saved before its error reached us.
+        try:
+            entry["collection"].update_one(
+                {"_id": chat_id},
+                {
+                    "$setOnInsert": entry["fields"],
+                    "$addToSet": {"chat": {"$each": entry["messages"]}},
+                    "$set": {"updated_at": datetime.now()}
+                },
+                upsert=True
+            )
+            del pending[chat_id]
+        except Exception:
+            delay = min(RETRY_DELAY * 2 ** entry["attempts"], MAX_RETRY_DELAY)
+            entry["attempts"] += 1
+            entry["retry_at"] = time.monotonic() + delay
+            logger.exception("Failed to save chat %s, retrying in %.1fs", chat_id, delay)
+
+atexit.register(flush, 5)
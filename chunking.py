@@ -0,0 +1,134 @@
+import os
+import re
+
+SENTENCE_BOUNDARY = re.compile(r'(?<=[.!?])\s+')
+TOKEN_PATTERN = re.compile(r'\w+|[^\w\s]')
+
+CHUNK_SIZE = int(os.getenv("CHUNK_SIZE", 800))
+CHUNK_OVERLAP = int(os.getenv("CHUNK_OVERLAP", 0))
+CHUNK_UNIT = os.getenv("CHUNK_UNIT", "chars")
+
+def count_tokens(text):
+    """Approximate token count: words and punctuation marks"""
+    return sum(1 for _ in TOKEN_PATTERN.finditer(text))
+
+class Chunker:
+    """Sentence-aligned text chunker with a size limit and optional overlap.
+
+    ``chunk_size`` and ``overlap`` are measured in characters
+    (``unit="chars"``) or approximate tokens (``unit="tokens"``). Each
+    sentence is measured once and chunks are joined once, so chunking is
+    linear in the input. Sentences longer than a chunk are split at the
+    last whitespace (or token boundary) that fits.
+    """
+    
+    def __init__(self, chunk_size=CHUNK_SIZE, overlap=CHUNK_OVERLAP, unit=CHUNK_UNIT):
+        if unit not in ("chars", "tokens"):
+            raise ValueError(f"Unknown chunk unit: {unit}")
+        if chunk_size <= 0 or not 0 <= overlap < chunk_size:
+            raise ValueError("chunk_size must be positive and overlap smaller than it")
+        self.chunk_size = chunk_size
+        self.overlap = overlap
+        self.unit = unit
+    
+    @property
+    def signature(self):
+        """Identifies the chunking settings; stored with every chunk"""
+        return f"{self.unit}:{self.chunk_size}:{self.overlap}"
+    
+    def measure(self, text):
+        return len(text) if self.unit == "chars" else count_tokens(text)
+    
+    def split(self, text):
+        """Chunk a single string"""
+        return [chunk for chunk, _ in self.iter_chunks([{"text": text}])]
+    
+    def iter_chunks(self, segments):
+        """Group a stream of text segments into chunks.
+
+        Yields ``(chunk, metadata)`` pairs; when segments carry a ``page``
+        the metadata records the ``page_start``/``page_end`` the chunk
+        spans. Segments with their own ``metadata`` (spreadsheet row
+        blocks) are passed through as single chunks.
+        """
+        # Each entry is (piece, length, page); ``length`` includes the
+        # joining space when measuring characters.
+        pieces = []
+        length = 0
+        separator = 1 if self.unit == "chars" else 0
+        limit = self.chunk_size + separator
+        
+        for segment in segments:
+            if "metadata" in segment:
+                if pieces:
+                    yield self._emit(pieces)
+                pieces, length = [], 0
+                if segment["text"].strip():
+                    yield segment["text"].strip(), segment["metadata"]
+                continue
+            
+            page = segment.get("page")
+            for sentence in SENTENCE_BOUNDARY.split(segment["text"]):
+                sentence = sentence.strip()
+                if not sentence:
+                    continue
+                size = self.measure(sentence)
+                fitted = [(sentence, size)] if size <= self.chunk_size else [
+                    (piece, self.measure(piece)) for piece in self._hard_split(sentence)
+                ]
+                for piece, size in fitted:
+                    size += separator
+                    if pieces and length + size > limit:
+                        yield self._emit(pieces)
+                        pieces, length = self._overlap_tail(pieces, limit - size)
+                    pieces.append((piece, size, page))
+                    length += size
+        
+        if pieces:
+            yield self._emit(pieces)
+    
+    def _hard_split(self, sentence):
+        """Split a sentence that is longer than a chunk at hard boundaries"""
+        if self.unit == "tokens":
+            ends = [match.end() for match in TOKEN_PATTERN.finditer(sentence)]
+            cuts = ends[self.chunk_size - 1::self.chunk_size]
+            parts, start = [], 0
+            for cut in cuts:
+                parts.append(sentence[start:cut])
+                start = cut
+            parts.append(sentence[start:])
+            return [part.strip() for part in parts if part.strip()]
+        
+        parts, start = [], 0
+        while len(sentence) - start > self.chunk_size:
+            end = start + self.chunk_size
+            space = sentence.rfind(" ", start + self.chunk_size // 2, end)
+            cut = space if space != -1 else end
+            parts.append(sentence[start:cut])
+            start = cut + 1 if space != -1 else cut
+        parts.append(sentence[start:])
+        return [part.strip() for part in parts if part.strip()]
+    
+    def _overlap_tail(self, pieces, room):
+        """Trailing pieces to repeat at the start of the next chunk"""
+        budget = min(self.overlap, room)
+        tail = []
+        length = 0
+        for piece in reversed(pieces):
+            if length + piece[1] > budget:
+                break
+            tail.append(piece)
+            length += piece[1]
+        tail.reverse()
+        return tail, length
+    
+    def _emit(self, pieces):
+        chunk = " ".join(piece for piece, _, _ in pieces)
+        page_start, page_end = pieces[0][2], pieces[-1][2]
+        if page_start is None:
+            return chunk, {}
+        return chunk, {"page_start": page_start, "page_end": page_end}
+
+def iter_chunks(segments, chunker=None):
+    """Chunk a segment stream with the given (or default) Chunker"""
+    return (chunker or Chunker()).iter_chunks(segments)
@@ -0,0 +1,77 @@
+import os
+
+CONTEXT_MAX_TURNS = int(os.getenv("CONTEXT_MAX_TURNS", 6))
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", 3000))
+SUMMARIZE_EVERY_TURNS = int(os.getenv("SUMMARIZE_EVERY_TURNS", 2))
+PROMPT_TOKEN_BUDGET = int(os.getenv("PROMPT_TOKEN_BUDGET", 1500))
+
+def estimate_tokens(text):
+    """Cheap token estimate (~4 characters per token) for budgeting"""
+    return len(text) // 4 + 1
+
+def new_summary_state():
+    """Running summary of the turns that fell out of the context window"""
+    return {"summary": "", "covered": 0}
+
+def build_context(messages, summary_state, summarize,
+                  max_turns=CONTEXT_MAX_TURNS, token_budget=CONTEXT_TOKEN_BUDGET,
+                  summarize_every=SUMMARIZE_EVERY_TURNS):
+    """Pick the messages to send for the next completion.
+
+    Keeps at most ``max_turns`` user/assistant pairs from the end of
+    ``messages`` that fit in ``token_budget`` (the latest message is always
+    kept). Older messages are folded into ``summary_state`` by calling
+    ``summarize(previous_summary, new_messages)`` only for messages not
+    summarized yet. To avoid a summary call on every turn, turns that
+    overflow ``max_turns`` are still sent verbatim until ``summarize_every``
+    of them have piled up, as long as they fit the budget. Returns a list
+    of ``{"role", "content"}`` dicts, led by a system message carrying the
+    summary when there is one.
+    """
+    budget = token_budget - estimate_tokens(summary_state["summary"])
+    start = len(messages)
+    used = 0
+    while start > 0:
+        cost = estimate_tokens(messages[start - 1]["content"])
+        if start < len(messages) and (
+            len(messages) - start >= max_turns * 2 or used + cost > budget
+        ):
+            break
+        start -= 1
+        used += cost
+    
+    # Never cut between a user message and its answer
+    if start < len(messages) and messages[start]["role"] == "assistant":
+        start += 1
+    start = min(start, len(messages) - 1) if messages else 0
+    
+    overflow = messages[summary_state["covered"]:start]
+    if overflow and len(overflow) < summarize_every * 2 and (
+        used + sum(estimate_tokens(message["content"]) for message in overflow) <= budget
+    ):
+        start = summary_state["covered"]
+    
+    if start > summary_state["covered"]:
+        try:
+            summary_state["summary"] = summarize(
+                summary_state["summary"], messages[summary_state["covered"]:start]
+            )
+            summary_state["covered"] = start
+        except Exception:
+            # Keep the old summary; the unsummarized turns are retried next time
+            pass
+    elif start < summary_state["covered"]:
+        # The window reaches back into turns the summary already covers;
+        # rely on the summary instead of sending them twice
+        start = summary_state["covered"]
+    
+    context = []
+    if summary_state["summary"]:
+        context.append({
+            "role": "system",
+            "content": f"Summary of the earlier conversation:\n{summary_state['summary']}"
+        })
+    context.extend(
+        {"role": message["role"], "content": message["content"]} for message in messages[start:]
+    )
+    return context
@@ -1,9 +1,31 @@
 import os
 import re
-import uuid
+import time
+import hashlib
+import threading
 from pathlib import Path
-from datetime import datetime
 import streamlit as st  # Added this import
+from cache import TTLCache
+from vector_store import open_user_collection, delete_user_documents, user_collection_name
+from retrieval import (
+    RERANK_CANDIDATES, RETRIEVAL_TOKEN_BUDGET, reciprocal_rank_fusion, rerank,
+    drop_near_duplicates, pack_to_budget, build_document_context
+)
+
+DEFAULT_BATCH_SIZE = int(os.getenv("CHROMA_BATCH_SIZE", 256))
+# Results cached across all collections
+QUERY_CACHE_SIZE = int(os.getenv("QUERY_CACHE_SIZE", 2048))
+QUERY_CACHE_TTL = int(os.getenv("QUERY_CACHE_TTL", 600))
+COMPACTION_PAGE_SIZE = int(os.getenv("COMPACTION_PAGE_SIZE", 1000))
+
+SEARCH_ERROR = "Error searching documents."
+
+_query_cache = TTLCache(QUERY_CACHE_SIZE, QUERY_CACHE_TTL)
+# Bumped on invalidation, so a collection's old entries are never hit
+# again and simply age out of the shared cache
+_query_generations = {}
+_query_generations_lock = threading.Lock()
+_indexed_chat_collections = set()
 
 def get_user_uploads_dir(user_id):
     """Get user-specific uploads directory path"""
@@ -19,91 +41,412 @@ def get_file_paths_from_uploads(user_id):
 
 def setup_document_collection(chroma_client, user_id):
     """Setup ChromaDB collection with documents for specific user"""
-    collection_name = f"user_{user_id}_documents"
-    
     try:
-        collection = chroma_client.get_or_create_collection(
-            name=collection_name,
-            metadata={"user_id": user_id, "created_at": datetime.now().isoformat()}
-        )
-        return collection
+        return open_user_collection(chroma_client, user_id)
     except Exception as e:
         st.error(f"Error in document setup: {e}")
         return None
 
+def file_content_hash(file_path):
+    """Return the SHA-256 hex digest of a file's bytes"""
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+def make_chunk_id(user_id, file_path, chunk):
+    """Deterministic chunk ID so identical chunks map to the same vector"""
+    digest = hashlib.sha256(f"{file_path}\0{chunk}".encode("utf-8")).hexdigest()
+    return f"{user_id}_{os.path.basename(file_path)}_{digest[:16]}"
+
+def get_indexed_chunks(collection, file_path):
+    """Return {chunk_id: metadata} already stored for a file.
+
+    The per-chunk ``content_hash`` and ``chunker`` metadata double as the
+    ingestion manifest: they record which version of the file, chunked
+    with which settings, the chunks came from, and they are cleared
+    together with the collection.
+    """
+    existing = collection.get(where={"source": file_path}, include=["metadatas"])
+    return dict(zip(existing["ids"], existing["metadatas"]))
+
+def is_up_to_date(indexed, manifest):
+    """True when every indexed chunk matches the file's manifest entries"""
+    return bool(indexed) and all(
+        all(metadata.get(key) == value for key, value in manifest.items())
+        for metadata in indexed.values()
+    )
+
+class ChunkWriter:
+    """Buffer chunk writes and flush them to a collection in bounded batches.
+
+    A batch that fails is retried on its own with exponential backoff;
+    batches that were already written are never sent again. Retries use
+    ``upsert`` so a batch Chroma partially applied cannot fail on
+    duplicate IDs. ``on_flush(count)`` is called after each written batch.
+    When given a ``lexical_index`` (BM25Index), written chunks are mirrored
+    into it.
+    """
+    
+    def __init__(self, collection, batch_size=DEFAULT_BATCH_SIZE, max_retries=3,
+                 retry_delay=1.0, on_flush=None, lexical_index=None):
+        max_batch_size = _max_batch_size(collection)
+        self.collection = collection
+        self.lexical_index = lexical_index
+        self.batch_size = min(batch_size, max_batch_size) if max_batch_size else batch_size
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self.on_flush = on_flush
+        self.written = 0
+        self._ids, self._documents, self._metadatas = [], [], []
+        self._update_ids, self._update_metadatas = [], []
+    
+    def add(self, chunk_id, document, metadata):
+        self._ids.append(chunk_id)
+        self._documents.append(document)
+        self._metadatas.append(metadata)
+        if len(self._ids) >= self.batch_size:
+            self._flush_adds()
+    
+    def update(self, chunk_id, metadata):
+        self._update_ids.append(chunk_id)
+        self._update_metadatas.append(metadata)
+        if len(self._update_ids) >= self.batch_size:
+            self._flush_updates()
+    
+    def flush(self):
+        self._flush_updates()
+        self._flush_adds()
+    
+    def discard(self):
+        """Drop anything still buffered, e.g. after a failed file"""
+        self._ids, self._documents, self._metadatas = [], [], []
+        self._update_ids, self._update_metadatas = [], []
+    
+    def _flush_adds(self):
+        if not self._ids:
+            return
+        ids, documents, metadatas = self._ids, self._documents, self._metadatas
+        self._ids, self._documents, self._metadatas = [], [], []
+        self._with_retry(
+            lambda: self.collection.add(ids=ids, documents=documents, metadatas=metadatas),
+            lambda: self.collection.upsert(ids=ids, documents=documents, metadatas=metadatas)
+        )
+        if self.lexical_index is not None:
+            self.lexical_index.add(ids, documents, metadatas)
+        self.written += len(ids)
+        if self.on_flush:
+            self.on_flush(len(ids))
+    
+    def _flush_updates(self):
+        if not self._update_ids:
+            return
+        ids, metadatas = self._update_ids, self._update_metadatas
+        self._update_ids, self._update_metadatas = [], []
+        write = lambda: self.collection.update(ids=ids, metadatas=metadatas)
+        self._with_retry(write, write)
+        if self.lexical_index is not None:
+            self.lexical_index.update_metadata(ids, metadatas)
+    
+    def _with_retry(self, write, retry_write):
+        for attempt in range(self.max_retries + 1):
+            try:
+                return (write if attempt == 0 else retry_write)()
+            except Exception:
+                if attempt == self.max_retries:
+                    raise
+                time.sleep(self.retry_delay * 2 ** attempt)
+
+def _max_batch_size(collection):
+    """Chroma's server-side limit on records per write, when it exposes one"""
+    client = getattr(collection, "_client", None)
+    try:
+        return client.max_batch_size if client is not None else None
+    except Exception:
+        return None
+
+def sync_file_chunks(collection, user_id, file_path, manifest, chunks,
+                     indexed=None, writer=None):
+    """Bring a file's chunks in the collection in line with ``chunks``.
+
+    ``chunks`` is an iterable of ``(text, metadata)`` pairs and is consumed
+    as a stream through ``writer`` (a ChunkWriter). The ``manifest`` entries
+    (content hash, chunker settings) are stored on every chunk. Only chunks
+    whose text is new get embedded; chunks that disappeared from the file
+    are deleted and unchanged ones just get their metadata refreshed.
+    Returns ``(added, removed, total)`` chunk counts.
+    """
+    if indexed is None:
+        indexed = get_indexed_chunks(collection, file_path)
+    if writer is None:
+        writer = ChunkWriter(collection)
+    
+    seen = set()
+    added = 0
+    
+    for chunk, extra_metadata in chunks:
+        chunk_id = make_chunk_id(user_id, file_path, chunk)
+        if chunk_id in seen:
+            continue
+        
+        metadata = {
+            "source": file_path,
+            "chunk_index": len(seen),
+            "user_id": user_id,
+            "filename": os.path.basename(file_path),
+            "file_type": os.path.splitext(file_path)[1],
+            **manifest,
+            **extra_metadata
+        }
+        seen.add(chunk_id)
+        
+        if chunk_id in indexed:
+            writer.update(chunk_id, metadata)
+        else:
+            writer.add(chunk_id, chunk, metadata)
+            added += 1
+    # Flush per file so a failure is always attributable to this file
+    writer.flush()
+    
+    stale_ids = [chunk_id for chunk_id in indexed if chunk_id not in seen]
+    if stale_ids:
+        collection.delete(ids=stale_ids)
+        if writer.lexical_index is not None:
+            writer.lexical_index.remove(stale_ids)
+    
+    return added, len(stale_ids), len(seen)
+
 def process_files_to_collection(file_paths, collection, user_id):
     """Process files and add to ChromaDB collection"""
-    from file_processing import read_file_content
-    
-    documents = []
-    metadatas = []
-    ids = []
-    
-    for file_path in file_paths:
-        content = read_file_content(file_path)
-        if content:
-            sentences = re.split(r'(?<=[.!?]) +', content)
-            chunks = []
-            current_chunk = ""
-            
-            for sentence in sentences:
-                if len(current_chunk) + len(sentence) < 800:
-                    current_chunk += sentence + " "
-                else:
-                    chunks.append(current_chunk.strip())
-                    current_chunk = sentence + " "
-            
-            if current_chunk:
-                chunks.append(current_chunk.strip())
-            
-            for i, chunk in enumerate(chunks):
-                documents.append(chunk)
-                metadatas.append({
-                    "source": file_path, 
-                    "chunk_index": i,
-                    "user_id": user_id,
-                    "filename": os.path.basename(file_path),
-                    "file_type": os.path.splitext(file_path)[1]
-                })
-                ids.append(f"{user_id}_{os.path.basename(file_path)}_{i}_{uuid.uuid4().hex[:6]}")
-    
-    if documents:
-        collection.add(
-            documents=documents,
-            metadatas=metadatas,
-            ids=ids
+    from ingestion import index_files
+    
+    progress_bar = st.progress(0.0, text="Indexing documents...")
+    
+    def show_progress(progress):
+        done = progress["files_done"] / max(progress["files_total"], 1)
+        progress_bar.progress(
+            min(done, 1.0),
+            text=f"Indexed {progress['files_done']}/{progress['files_total']} files "
+                 f"({progress['chunks_written']} chunks written)"
         )
-        st.success(f"Added {len(documents)} document chunks from {len(file_paths)} files!")
-    else:
+    
+    stats = index_files(file_paths, collection, user_id, progress=show_progress)
+    progress_bar.empty()
+    
+    if stats["indexed"]:
+        st.success(
+            f"Added {stats['added']} document chunks from {stats['indexed']} files!"
+            + (f" Removed {stats['removed']} stale chunks." if stats["removed"] else "")
+        )
+    if stats["skipped"]:
+        st.info(f"{stats['skipped']} unchanged files were already indexed.")
+    for file_path, error in stats["errors"]:
+        st.error(f"Error reading file {os.path.basename(file_path)}: {error}")
+    if not stats["indexed"] and not stats["skipped"] and not stats["errors"]:
         st.warning("No valid content found in provided files!")
     
     return collection
 
-def query_documents(question, collection, n_results=3):
-    """Query documents using ChromaDB"""
+def _normalize_question(question):
+    return " ".join(question.lower().split()).rstrip("?!. ")
+
+def invalidate_query_cache(collection_name):
+    """Forget cached query results for a collection after it changed"""
+    with _query_generations_lock:
+        _query_generations[collection_name] = _query_generations.get(collection_name, 0) + 1
+
+def documents_changed(collection_name, user_id):
+    """Invalidate everything derived from a user's documents"""
+    from response_cache import response_cache
+    
+    invalidate_query_cache(collection_name)
+    response_cache.invalidate_user(user_id)
+
+def delete_document(collection, user_id, file_path):
+    """Delete an uploaded file along with its chunks and derived caches.
+
+    Chunks are removed by ``source`` first, so a failure leaves the file
+    in place and the delete can simply be retried.
+    """
+    from lexical_index import get_lexical_index
+    
+    collection.delete(where={"source": file_path})
+    lexical_index = get_lexical_index(collection)
+    lexical_index.remove_where(source=file_path)
+    documents_changed(collection.name, user_id)
+    
+    from blob_store import release
+    release(user_id, file_path)
+
+def clear_documents(chroma_client, user_id):
+    """Delete all of a user's documents, chunks and uploads; returns a fresh collection"""
+    from blob_store import release_all
+    from lexical_index import drop_lexical_index
+    
+    collection_name = user_collection_name(user_id)
+    delete_user_documents(chroma_client, user_id)
+    drop_lexical_index(collection_name)
+    documents_changed(collection_name, user_id)
+    
+    release_all(user_id)
+    
+    return open_user_collection(chroma_client, user_id)
+
+def compact_collection(collection, user_id, page_size=COMPACTION_PAGE_SIZE):
+    """Drop chunks whose source file no longer exists and resync BM25.
+
+    Catches files removed outside delete_document (by hand, or by a crash
+    between the two steps). The lexical index is brought back in line
+    with the collection in the same pass. Returns the number of chunks
+    removed.
+    """
+    from lexical_index import get_lexical_index
+    
+    sources = {}
+    offset = 0
+    while True:
+        page = collection.get(include=["metadatas"], limit=page_size, offset=offset)
+        for chunk_id, metadata in zip(page["ids"], page["metadatas"]):
+            sources.setdefault((metadata or {}).get("source"), []).append(chunk_id)
+        if len(page["ids"]) < page_size:
+            break
+        offset += page_size
+    
+    orphaned = [source for source in sources if source and not os.path.exists(source)]
+    removed = 0
+    for source in orphaned:
+        collection.delete(where={"source": source})
+        removed += len(sources.pop(source))
+    
+    lexical_index = get_lexical_index(collection)
+    live_ids = {chunk_id for chunk_ids in sources.values() for chunk_id in chunk_ids}
+    indexed_ids = lexical_index.ids()
+    stale_ids = [doc_id for doc_id in indexed_ids if doc_id not in live_ids]
+    missing_ids = [chunk_id for chunk_id in live_ids if chunk_id not in indexed_ids]
+    for start in range(0, len(missing_ids), page_size):
+        missing = collection.get(ids=missing_ids[start:start + page_size], include=["documents", "metadatas"])
+        lexical_index.add(missing["ids"], missing["documents"], missing["metadatas"])
+    if stale_ids:
+        lexical_index.remove(stale_ids)
+    
+    if removed or stale_ids:
+        documents_changed(collection.name, user_id)
+    return removed
+
+def search_documents(question, collection, n_results=3,
+                     n_candidates=RERANK_CANDIDATES, token_budget=RETRIEVAL_TOKEN_BUDGET):
+    """Hybrid dense + BM25 search, reranked and packed into a token budget.
+
+    ``n_candidates`` fused hits are reranked by term overlap and at most
+    ``n_results`` of them, totalling about ``token_budget`` tokens, are
+    returned. Results are cached in one bounded cache, keyed on the
+    collection, the normalized question and limits; ingestion and
+    clearing call documents_changed.
+    """
+    key = (
+        collection.name, _query_generations.get(collection.name, 0),
+        _normalize_question(question), n_results, n_candidates, token_budget
+    )
+    results = _query_cache.get(key)
+    if results is None:
+        candidates = rerank(question, _hybrid_query(question, collection, max(n_candidates, n_results)))
+        candidates = drop_near_duplicates(candidates)
+        packed = pack_to_budget(candidates, token_budget, limit=n_results)
+        results = {
+            "ids": [[chunk_id for chunk_id, _, _ in packed]],
+            "documents": [[document for _, document, _ in packed]],
+            "metadatas": [[metadata for _, _, metadata in packed]]
+        }
+        _query_cache.set(key, results)
+    return results
+
+def _hybrid_query(question, collection, n_results):
+    """Fuse Chroma's dense hits with BM25 hits by reciprocal rank.
+
+    Returns up to ``n_results`` ``(id, document, metadata)`` candidates,
+    best first. Exact terms (names, codes, spreadsheet values) that
+    embeddings miss are picked up lexically, so the dense side can stay
+    small.
+    """
+    from lexical_index import get_lexical_index
+    
+    dense = collection.query(query_texts=[question], n_results=max(1, n_results // 2 + 1))
+    candidates = {}
+    dense_ids = []
+    if dense and dense["ids"] and dense["ids"][0]:
+        for chunk_id, document, metadata in zip(dense["ids"][0], dense["documents"][0], dense["metadatas"][0]):
+            candidates[chunk_id] = (document, metadata)
+            dense_ids.append(chunk_id)
+    
+    lexical_ids = []
     try:
-        results = collection.query(
-            query_texts=[question],
-            n_results=n_results
-        )
+        for chunk_id, document, metadata, _ in get_lexical_index(collection).search(question, k=n_results):
+            candidates.setdefault(chunk_id, (document, metadata))
+            lexical_ids.append(chunk_id)
+    except Exception:
+        # The lexical side is an enhancement; dense results still stand
+        pass
+    
+    fused = reciprocal_rank_fusion([dense_ids, lexical_ids])[:n_results]
+    return [(chunk_id,) + candidates[chunk_id] for chunk_id in fused]
+
+def query_documents(question, collection, n_results=3, token_budget=RETRIEVAL_TOKEN_BUDGET):
+    """Query documents and format them as prompt context within token_budget"""
+    try:
+        results = search_documents(question, collection, n_results, token_budget=token_budget)
         
         if results and results['documents'] and results['documents'][0]:
-            relevant_content = "\n\n".join([
-                f" Source: {results['metadatas'][0][i].get('filename', 'Unknown')}\n"
-                f"Content: {doc}\n"
-                for i, doc in enumerate(results['documents'][0])
-            ])
+            relevant_content = build_document_context(
+                list(zip(results['ids'][0], results['documents'][0], results['metadatas'][0])),
+                token_budget
+            )
             return relevant_content
         else:
             return "No relevant information found in documents."
     
     except Exception as e:
         st.error(f"Error querying documents: {e}")
-        return "Error searching documents."
+        return SEARCH_ERROR
+
+def ensure_chat_indexes(collection):
+    """Create the index behind chat-history listing, once per process"""
+    if collection.full_name in _indexed_chat_collections:
+        return
+    collection.create_index([("user_id", 1), ("timestamp", -1), ("_id", -1)])
+    _indexed_chat_collections.add(collection.full_name)
+
+def list_my_chats(collection, user_id, limit=5, before=None):
+    """Return one page of a user's chats, newest first, without messages.
+
+    Only ``_id``, ``title``, ``timestamp`` and ``mode`` are fetched.
+    ``before`` is the cursor returned for the previous page; the result is
+    ``(chats, next_cursor)`` with ``next_cursor`` None on the last page.
+    ``limit=0`` returns every chat in one page.
+    """
+    query = {"user_id": user_id}
+    if before is not None:
+        timestamp, chat_id = before
+        query["$or"] = [
+            {"timestamp": {"$lt": timestamp}},
+            {"timestamp": timestamp, "_id": {"$lt": chat_id}}
+        ]
+    
+    cursor = collection.find(
+        query, {"title": 1, "timestamp": 1, "mode": 1}
+    ).sort([("timestamp", -1), ("_id", -1)])
+    if limit:
+        cursor = cursor.limit(limit + 1)
+    chats = list(cursor)
+    
+    if not limit or len(chats) <= limit:
+        return chats, None
+    chats = chats[:limit]
+    return chats, (chats[-1].get("timestamp"), chats[-1]["_id"])
 
-def list_my_chats(collection, user_id):
-    chats = list(collection.find({"user_id": user_id}).sort("timestamp", -1))
-    return chats
+def load_chat(collection, chat_id, user_id):
+    """Fetch a single chat with its messages when it is opened"""
+    return collection.find_one({"_id": chat_id, "user_id": user_id})
 
 def generate_chat_title(first_message):
     """Generate a title from the first message"""
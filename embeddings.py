@@ -0,0 +1,154 @@
+import os
+import hashlib
+import threading
+
+import numpy as np
+
+from file_lock import FileLock
+
+EMBEDDING_MODEL = os.getenv("EMBEDDING_MODEL", "default")
+EMBEDDING_CACHE_DIR = os.getenv("EMBEDDING_CACHE_DIR", "./embedding_cache")
+EMBED_BATCH_SIZE = int(os.getenv("EMBED_BATCH_SIZE", 64))
+
+class EmbeddingStore:
+    """Append-only, memory-mapped float32 store of vectors keyed by hash.
+
+    ``vectors.f32`` holds the rows back to back and ``keys.txt`` one
+    ``key,row`` line per vector. Rows are written before their keys, so a
+    key on disk always points at a complete row, even after a crash
+    between the two writes. Other processes' appends are picked up by
+    reading the key file's new lines when it grows.
+    """
+    
+    def __init__(self, directory, dim=None):
+        self.directory = directory
+        self.dim = dim
+        self.vectors_path = os.path.join(directory, "vectors.f32")
+        self.keys_path = os.path.join(directory, "keys.txt")
+        self.lock_path = os.path.join(directory, ".lock")
+        self._rows = {}
+        self._keys_offset = 0
+        self._matrix = None
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        dim_path = os.path.join(directory, "dim")
+        if os.path.exists(dim_path):
+            with open(dim_path) as f:
+                self.dim = int(f.read())
+    
+    def get_many(self, keys):
+        """Return ``{key: vector}`` for the keys present in the store"""
+        with self._lock:
+            self._refresh()
+            found = {key: self._rows[key] for key in keys if key in self._rows}
+            if not found:
+                return {}
+            matrix = self._map(max(found.values()) + 1)
+            return {key: np.array(matrix[row]) for key, row in found.items()}
+    
+    def put_many(self, keys, vectors):
+        vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+        with self._lock, self._file_lock():
+            self._refresh()
+            if self.dim is None:
+                self.dim = vectors.shape[1]
+                with open(os.path.join(self.directory, "dim"), "w") as f:
+                    f.write(str(self.dim))
+            new = [i for i, key in enumerate(keys) if key not in self._rows]
+            if not new:
+                return
+            first_row = os.path.getsize(self.vectors_path) // (4 * self.dim) if os.path.exists(self.vectors_path) else 0
+            with open(self.vectors_path, "ab") as f:
+                f.seek(first_row * 4 * self.dim)
+                f.truncate()
+                f.write(vectors[new].tobytes())
+            with open(self.keys_path, "a", encoding="ascii") as f:
+                f.write("".join(f"{keys[i]},{first_row + j}\n" for j, i in enumerate(new)))
+            self._refresh()
+    
+    def __len__(self):
+        with self._lock:
+            self._refresh()
+            return len(self._rows)
+    
+    def _refresh(self):
+        if not os.path.exists(self.keys_path):
+            return
+        if os.path.getsize(self.keys_path) == self._keys_offset:
+            return
+        with open(self.keys_path, "r", encoding="ascii") as f:
+            f.seek(self._keys_offset)
+            for line in f:
+                if not line.endswith("\n"):
+                    break
+                key, row = line[:-1].split(",")
+                self._rows.setdefault(key, int(row))
+                self._keys_offset += len(line)
+    
+    def _map(self, rows_needed):
+        if self._matrix is None or self._matrix.shape[0] < rows_needed:
+            rows = os.path.getsize(self.vectors_path) // (4 * self.dim)
+            self._matrix = np.memmap(self.vectors_path, dtype=np.float32, mode="r", shape=(rows, self.dim))
+        return self._matrix
+    
+    def _file_lock(self):
+        return FileLock(self.lock_path)
+
+def load_encoder(model=EMBEDDING_MODEL):
+    """Return a function mapping a list of texts to a float32 matrix"""
+    from chromadb.utils import embedding_functions
+    
+    if model == "default":
+        function = embedding_functions.DefaultEmbeddingFunction()
+    else:
+        function = embedding_functions.SentenceTransformerEmbeddingFunction(model_name=model)
+    return lambda texts: np.asarray(function(texts), dtype=np.float32)
+
+class CachedEmbeddingFunction:
+    """Chroma embedding function backed by an on-disk embedding cache.
+
+    Texts are keyed by SHA-256 of the model name and text, so identical
+    chunks and repeated questions are embedded once across all users and
+    restarts. Only cache misses are encoded, in batches of ``batch_size``.
+    """
+    
+    def __init__(self, encoder=None, model=EMBEDDING_MODEL, cache_dir=EMBEDDING_CACHE_DIR,
+                 batch_size=EMBED_BATCH_SIZE):
+        self.model = model
+        self.batch_size = batch_size
+        self._encoder = encoder
+        self.store = EmbeddingStore(os.path.join(cache_dir, _safe_name(model)))
+    
+    def __call__(self, input):
+        return [vector.tolist() for vector in self.embed(list(input))]
+    
+    def embed(self, texts):
+        """Return a float32 matrix with one row per text"""
+        keys = [self._key(text) for text in texts]
+        cached = self.store.get_many(keys)
+        
+        missing = {}
+        for key, text in zip(keys, texts):
+            if key not in cached and key not in missing:
+                missing[key] = text
+        if missing:
+            missing_keys = list(missing)
+            for start in range(0, len(missing_keys), self.batch_size):
+                batch = missing_keys[start:start + self.batch_size]
+                vectors = self.encoder([missing[key] for key in batch])
+                self.store.put_many(batch, vectors)
+                cached.update(zip(batch, vectors))
+        
+        return np.stack([cached[key] for key in keys]) if keys else np.zeros((0, self.store.dim or 0), np.float32)
+    
+    @property
+    def encoder(self):
+        if self._encoder is None:
+            self._encoder = load_encoder(self.model)
+        return self._encoder
+    
+    def _key(self, text):
+        return hashlib.sha256(f"{self.model}\0{text}".encode("utf-8")).hexdigest()
+
+def _safe_name(model):
+    return "".join(char if char.isalnum() or char in "-_." else "_" for char in model)
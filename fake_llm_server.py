@@ -0,0 +1,142 @@
+"""Offline stand-in for the chat completions endpoint.
+
+Run ``python fake_llm_server.py --port 8765`` and start the app with
+``AI21_API_BASE=http://127.0.0.1:8765`` to exercise the LLM gateway
+(streaming, retries, timeouts) without network access or an API key.
+``python fake_llm_server.py --check`` runs the gateway's deadline checks
+against a private server and exits.
+"""
+import json
+import time
+import argparse
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+class FakeLLMHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    
+    def do_POST(self):
+        server = self.server
+        length = int(self.headers.get("Content-Length", 0))
+        payload = json.loads(self.rfile.read(length) or b"{}")
+        
+        with server.lock:
+            server.requests += 1
+            failing = server.requests <= server.fail_first
+        if server.delay:
+            time.sleep(server.delay)
+        if failing:
+            self._send(503, "application/json", b'{"detail": "temporarily unavailable"}')
+            return
+        
+        last = payload.get("messages", [{}])[-1].get("content", "")
+        answer = server.answer or f"Echo: {last}"
+        
+        if not payload.get("stream"):
+            body = {"choices": [{"index": 0, "message": {"role": "assistant", "content": answer}}]}
+            self._send(200, "application/json", json.dumps(body).encode("utf-8"))
+            return
+        
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        self.close_connection = True
+        try:
+            for word in answer.split(" "):
+                chunk = {"choices": [{"index": 0, "delta": {"content": word + " "}}]}
+                self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode("utf-8"))
+                self.wfile.flush()
+                if server.token_delay:
+                    time.sleep(server.token_delay)
+            self.wfile.write(b"data: [DONE]\n\n")
+            self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            pass  # The client gave up, e.g. at its deadline
+    
+    def _send(self, status, content_type, body):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+    
+    def log_message(self, format, *args):
+        pass
+
+def start_fake_server(port=0, answer=None, fail_first=0, delay=0.0, token_delay=0.0):
+    """Serve in a background thread; returns ``(server, base_url)``"""
+    server = ThreadingHTTPServer(("127.0.0.1", port), FakeLLMHandler)
+    server.daemon_threads = True
+    server.lock = threading.Lock()
+    server.requests = 0
+    server.answer = answer
+    server.fail_first = fail_first
+    server.delay = delay
+    server.token_delay = token_delay
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}"
+
+def check_deadlines():
+    """Check that gateway deadlines bound the whole request, not each read"""
+    from llm_gateway import LLMGateway, LLMError
+    
+    messages = [{"role": "user", "content": "deadline check"}]
+    slow_answer = " ".join(["word"] * 50)
+    
+    # 50 tokens 0.1 s apart would take 5 s; each read alone is well inside 1 s
+    server, url = start_fake_server(answer=slow_answer, token_delay=0.1)
+    gateway = LLMGateway("test", base_url=url, max_retries=0)
+    try:
+        started = time.monotonic()
+        pieces = []
+        try:
+            for delta in gateway.stream(messages, deadline=1.0):
+                pieces.append(delta)
+            raise AssertionError("slow stream finished inside its deadline")
+        except LLMError:
+            pass
+        elapsed = time.monotonic() - started
+        assert elapsed < 1.5, f"stream ran {elapsed:.1f}s past a 1.0s deadline"
+        assert 0 < len(pieces) < 50, f"got {len(pieces)} of 50 pieces"
+        print(f"stream deadline: stopped after {elapsed:.2f}s with {len(pieces)} pieces")
+        
+        server.delay = 2.0
+        started = time.monotonic()
+        try:
+            gateway.complete(messages, deadline=0.5)
+            raise AssertionError("slow completion finished inside its deadline")
+        except LLMError:
+            pass
+        elapsed = time.monotonic() - started
+        assert elapsed < 1.0, f"completion ran {elapsed:.1f}s past a 0.5s deadline"
+        print(f"completion deadline: stopped after {elapsed:.2f}s")
+        
+        server.delay, server.token_delay = 0.0, 0.0
+        answer = "".join(gateway.stream(messages, deadline=5.0))
+        assert answer.strip() == slow_answer, "fast stream was cut short"
+        print("fast stream: complete")
+    finally:
+        gateway.close()
+        server.shutdown()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fake chat completions server")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--answer", default=None)
+    parser.add_argument("--fail-first", type=int, default=0, help="answer the first N requests with 503")
+    parser.add_argument("--delay", type=float, default=0.0, help="seconds before each response")
+    parser.add_argument("--token-delay", type=float, default=0.05)
+    parser.add_argument("--check", action="store_true", help="run the gateway deadline checks and exit")
+    args = parser.parse_args()
+    
+    if args.check:
+        check_deadlines()
+        raise SystemExit(0)
+    
+    server, url = start_fake_server(args.port, args.answer, args.fail_first, args.delay, args.token_delay)
+    print(f"Fake LLM server listening on {url}")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
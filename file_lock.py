@@ -0,0 +1,26 @@
+try:
+    import fcntl
+except ImportError:  # Windows: callers fall back to their in-process locks only
+    fcntl = None
+
+class FileLock:
+    """Exclusive ``flock`` on ``path``, shared by every process on the host.
+    
+    Locks are per open file, so threads of one process exclude each
+    other too; where ``fcntl`` is missing this is a no-op.
+    """
+    
+    def __init__(self, path):
+        self.path = path
+        self.handle = None
+    
+    def __enter__(self):
+        self.handle = open(self.path, "a")
+        if fcntl is not None:
+            fcntl.flock(self.handle, fcntl.LOCK_EX)
+        return self
+    
+    def __exit__(self, *exc):
+        if fcntl is not None:
+            fcntl.flock(self.handle, fcntl.LOCK_UN)
+        self.handle.close()
@@ -2,49 +2,118 @@ import PyPDF2
 import docx
 import json
 import openpyxl
+import streamlit as st
 
-def read_file_content(file_path):
-    """Read content from various file formats"""
+TEXT_BLOCK_SIZE = 64 * 1024
+XLSX_ROWS_PER_CHUNK = 25
+XLSX_MAX_CHUNK_CHARS = 2000
+
+def _iter_text_blocks(file_path, block_size=TEXT_BLOCK_SIZE):
+    """Yield a text file in line-aligned blocks of about block_size characters"""
+    with open(file_path, 'r', encoding='utf-8') as f:
+        lines = []
+        size = 0
+        for line in f:
+            lines.append(line)
+            size += len(line)
+            if size >= block_size:
+                yield "".join(lines)
+                lines = []
+                size = 0
+        if lines:
+            yield "".join(lines)
+
+def _format_row(row):
+    return " | ".join([str(cell) if cell is not None else "" for cell in row])
+
+def _iter_sheet_blocks(file_path, rows_per_chunk=XLSX_ROWS_PER_CHUNK,
+                       max_chars=XLSX_MAX_CHUNK_CHARS):
+    """Yield each sheet as blocks of whole rows with the header row repeated.
+
+    The workbook is opened read-only so rows are streamed from the file
+    rather than materialised as cell objects. Every block is a ready-made
+    chunk carrying its sheet name and 1-based row range.
+    """
+    workbook = openpyxl.load_workbook(file_path, read_only=True, data_only=True)
     try:
-        if file_path.endswith('.txt'):
-            with open(file_path, 'r', encoding='utf-8') as f:
-                return f.read()
-        
-        elif file_path.endswith('.pdf'):
-            content = ""
-            with open(file_path, 'rb') as f:
-                pdf_reader = PyPDF2.PdfReader(f)
-                for page in pdf_reader.pages:
-                    content += page.extract_text() + "\n"
-            return content
-        
-        elif file_path.endswith('.docx'):
-            doc = docx.Document(file_path)
-            content = "\n".join([paragraph.text for paragraph in doc.paragraphs])
-            return content
-        
-        elif file_path.endswith('.json'):
-            with open(file_path, 'r', encoding='utf-8') as f:
-                data = json.load(f)
-                return json.dumps(data, indent=2)
-        
-        elif file_path.endswith('.xlsx'):
-            content = ""
-            workbook = openpyxl.load_workbook(file_path)
+        for sheet in workbook.worksheets:
+            header = None
+            rows = []
+            size = 0
+            row_start = None
             
-            for sheet_name in workbook.sheetnames:
-                sheet = workbook[sheet_name]
-                content += f"\n--- Sheet: {sheet_name} ---\n"
+            for row_number, row in enumerate(sheet.iter_rows(values_only=True), start=1):
+                if not any(cell is not None and str(cell).strip() for cell in row):
+                    continue
+                row_content = _format_row(row)
+                if header is None:
+                    header = row_content
+                    header_row = row_number
+                    continue
+                if not rows:
+                    row_start = row_number
+                rows.append(row_content)
+                size += len(row_content) + 1
+                row_end = row_number
                 
-                for row in sheet.iter_rows(values_only=True):
-                    row_content = " | ".join([str(cell) if cell is not None else "" for cell in row])
-                    content += row_content + "\n"
+                if len(rows) >= rows_per_chunk or size >= max_chars:
+                    yield _sheet_block(sheet.title, header, rows, row_start, row_end)
+                    rows = []
+                    size = 0
             
-            return content
-        
-        else:
-            return ""
+            if rows:
+                yield _sheet_block(sheet.title, header, rows, row_start, row_end)
+            elif header is not None:
+                # A sheet with only one populated row still gets indexed
+                yield _sheet_block(sheet.title, header, [], header_row, header_row)
+    finally:
+        workbook.close()
+
+def _sheet_block(sheet_name, header, rows, row_start, row_end):
+    text = f"--- Sheet: {sheet_name} ---\n" + "\n".join([header] + rows) + "\n"
+    return {
+        "text": text,
+        "metadata": {"sheet": sheet_name, "row_start": row_start, "row_end": row_end}
+    }
+
+def _iter_segments(file_path):
+    if file_path.endswith('.txt'):
+        for block in _iter_text_blocks(file_path):
+            yield {"text": block}
+    
+    elif file_path.endswith('.pdf'):
+        with open(file_path, 'rb') as f:
+            pdf_reader = PyPDF2.PdfReader(f)
+            for page_number, page in enumerate(pdf_reader.pages, start=1):
+                yield {"text": (page.extract_text() or "") + "\n", "page": page_number}
     
+    elif file_path.endswith('.docx'):
+        doc = docx.Document(file_path)
+        yield {"text": "\n".join([paragraph.text for paragraph in doc.paragraphs])}
+    
+    elif file_path.endswith('.json'):
+        with open(file_path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+            yield {"text": json.dumps(data, indent=2)}
+    
+    elif file_path.endswith('.xlsx'):
+        yield from _iter_sheet_blocks(file_path)
+
+def iter_file_content(file_path):
+    """Yield a file's text as segments: {"text": ..., "page": n} for PDFs.
+
+    Only one segment (a PDF page, a block of a text file, a block of
+    spreadsheet rows) is held at a time, so callers can chunk large
+    documents without loading them whole. Segments that carry a
+    ``metadata`` dict are complete chunks and must not be re-split.
+    Unlike read_file_content, parse errors are raised to the caller.
+    """
+    yield from _iter_segments(file_path)
+
+def read_file_content(file_path):
+    """Read content from various file formats"""
+    try:
+        return "".join(segment["text"] for segment in iter_file_content(file_path))
     except Exception as e:
         st.error(f"Error reading file {file_path}: {e}")
-        return ""
\ No newline at end of file
+        return ""
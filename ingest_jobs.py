@@ -0,0 +1,321 @@
+import os
+import socket
+import logging
+import threading
+import time
+from datetime import datetime, timedelta
+
+from pymongo import ReturnDocument
+
+JOBS_COLLECTION = "ingest_jobs"
+JOB_POLL_SECONDS = float(os.getenv("INGEST_JOB_POLL_SECONDS", 2))
+JOB_STALE_SECONDS = int(os.getenv("INGEST_JOB_STALE_SECONDS", 600))
+JOB_MAX_ATTEMPTS = int(os.getenv("INGEST_JOB_MAX_ATTEMPTS", 3))
+# Running jobs touch ``updated_at`` this often even when no progress is reported
+JOB_HEARTBEAT_SECONDS = max(JOB_STALE_SECONDS / 4, 1)
+PROGRESS_WRITE_INTERVAL = 1.0
+COMPACTION_INTERVAL_SECONDS = int(os.getenv("COMPACTION_INTERVAL_SECONDS", 24 * 3600))
+
+# Job kinds; jobs without a ``kind`` index files
+COMPACT = "compact"
+
+STORING = "storing"
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+logger = logging.getLogger(__name__)
+
+_wake = threading.Event()
+_worker = None
+_worker_lock = threading.Lock()
+_indexed_job_collections = set()
+
+def get_jobs_collection():
+    from resources import get_mongo_client
+    return get_mongo_client()["intern_data"][JOBS_COLLECTION]
+
+def ensure_job_indexes(jobs):
+    """Indexes behind claiming the oldest queued job and listing a user's jobs, once per process"""
+    if jobs.full_name in _indexed_job_collections:
+        return
+    jobs.create_index([("status", 1), ("created_at", 1)])
+    jobs.create_index([("user_id", 1), ("created_at", -1)])
+    _indexed_job_collections.add(jobs.full_name)
+
+def _worker_name():
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+def create_storing_job(jobs, user_id, names):
+    """Record a job for uploads that are still being written to disk.
+    
+    The job lives in MongoDB, so it keeps running (and stays visible)
+    across browser refreshes and is picked up again after a restart.
+    It is created on the request thread before the uploads are handed
+    off, so the files show up at once and a failure to store them is
+    recorded on the job instead of only in the log. ``queue_stored_files``
+    queues it once storing ends. Returns the job ``_id``.
+    """
+    now = datetime.now()
+    job = {
+        "user_id": user_id,
+        "status": STORING,
+        "worker": _worker_name(),
+        "files": [{"path": None, "name": name, "status": STORING, "error": None} for name in names],
+        "progress": {"files_done": 0, "files_total": len(names), "chunks_written": 0},
+        "attempts": 0,
+        "created_at": now,
+        "updated_at": now
+    }
+    jobs.insert_one(job)
+    return job["_id"]
+
+def queue_stored_files(jobs, job_id, results):
+    """Queue a storing job with its ``(path, error)`` results, one per file.
+    
+    Files that could not be stored are marked failed; the job fails
+    outright if none was stored.
+    """
+    update = {"updated_at": datetime.now()}
+    stored = 0
+    for i, (path, error) in enumerate(results):
+        update[f"files.{i}.path"] = path
+        if path is not None:
+            update[f"files.{i}.name"] = os.path.basename(path)
+        update[f"files.{i}.status"] = FAILED if error else QUEUED
+        update[f"files.{i}.error"] = error
+        stored += error is None
+    if stored:
+        update["status"] = QUEUED
+    else:
+        update.update({"status": FAILED, "error": "No file could be stored", "finished_at": datetime.now()})
+    jobs.update_one({"_id": job_id, "status": STORING}, {"$set": update})
+    if stored:
+        start_worker()
+        _wake.set()
+
+def list_jobs(jobs, user_id, limit=5):
+    """Return a user's most recent indexing jobs that have not been dismissed"""
+    return list(
+        jobs.find({"user_id": user_id, "kind": {"$ne": COMPACT}, "dismissed": {"$ne": True}})
+        .sort("created_at", -1)
+        .limit(limit)
+    )
+
+def has_active_jobs(jobs, user_id):
+    """True while any of a user's indexing jobs is storing, queued or running"""
+    return jobs.find_one(
+        {"user_id": user_id, "kind": {"$ne": COMPACT}, "status": {"$in": [STORING, QUEUED, RUNNING]}},
+        {"_id": 1}
+    ) is not None
+
+def request_compaction(jobs, user_id):
+    """Queue a compaction of a user's documents unless one ran recently.
+    
+    Compaction scans the whole collection, so it runs in the ingestion
+    worker rather than on the request thread, at most once per
+    COMPACTION_INTERVAL_SECONDS per user; the last run is read back from
+    the jobs collection. Returns True if a job was queued.
+    """
+    since = datetime.now() - timedelta(seconds=COMPACTION_INTERVAL_SECONDS)
+    recent = jobs.find_one(
+        {"user_id": user_id, "kind": COMPACT, "status": {"$ne": FAILED}, "created_at": {"$gte": since}},
+        {"_id": 1}
+    )
+    if recent is not None:
+        return False
+    now = datetime.now()
+    jobs.insert_one({
+        "user_id": user_id,
+        "kind": COMPACT,
+        "status": QUEUED,
+        "files": [],
+        "attempts": 0,
+        "created_at": now,
+        "updated_at": now
+    })
+    start_worker()
+    _wake.set()
+    return True
+
+def dismiss_finished_jobs(jobs, user_id):
+    """Hide a user's done and failed jobs from the sidebar"""
+    jobs.update_many(
+        {"user_id": user_id, "status": {"$in": [DONE, FAILED]}},
+        {"$set": {"dismissed": True}}
+    )
+
+def claim_next_job(jobs):
+    """Atomically move the oldest queued job to running and return it"""
+    now = datetime.now()
+    return jobs.find_one_and_update(
+        {"status": QUEUED},
+        {
+            "$set": {"status": RUNNING, "worker": _worker_name(), "started_at": now, "updated_at": now},
+            "$inc": {"attempts": 1}
+        },
+        sort=[("created_at", 1)],
+        return_document=ReturnDocument.AFTER
+    )
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+def requeue_interrupted_jobs(jobs):
+    """Put running jobs whose worker is gone back in the queue.
+    
+    A job is orphaned when its worker was a process on this host that no
+    longer exists, or when it has not reported progress for
+    JOB_STALE_SECONDS. Jobs that already used JOB_MAX_ATTEMPTS fail
+    instead, so a file that crashes the server cannot loop forever.
+    Orphaned storing jobs fail, since their uploads are gone.
+    """
+    host = socket.gethostname()
+    stale_before = datetime.now() - timedelta(seconds=JOB_STALE_SECONDS)
+    
+    orphaned = []
+    for job in jobs.find({"status": {"$in": [STORING, RUNNING]}}, {"status": 1, "worker": 1, "updated_at": 1, "attempts": 1}):
+        worker_host, _, pid = (job.get("worker") or "").rpartition(":")
+        if worker_host == host and pid.isdigit():
+            gone = int(pid) != os.getpid() and not _pid_alive(int(pid))
+        else:
+            gone = job.get("updated_at") is None or job["updated_at"] < stale_before
+        if gone:
+            orphaned.append(job)
+    
+    for job in orphaned:
+        if job["status"] == STORING:
+            update = {"status": FAILED, "error": "Interrupted while storing uploads", "finished_at": datetime.now()}
+        elif job.get("attempts", 0) >= JOB_MAX_ATTEMPTS:
+            update = {"status": FAILED, "error": "Interrupted too many times", "finished_at": datetime.now()}
+        else:
+            update = {"status": QUEUED}
+        # Only touch the job if no other worker has claimed it meanwhile
+        jobs.update_one({"_id": job["_id"], "status": job["status"], "worker": job.get("worker")},
+                        {"$set": dict(update, updated_at=datetime.now())})
+
+def run_job(jobs, job, chroma_client):
+    """Index a claimed job's files, recording per-file progress as it goes"""
+    from ingestion import index_files
+    from vector_store import open_user_collection
+    
+    # Files that failed to store have no path and are not indexed
+    positions = {file["path"]: i for i, file in enumerate(job["files"]) if file["path"] is not None}
+    last_write = [0.0]
+    
+    def record(progress):
+        now = time.monotonic()
+        finished = progress["finished"]
+        if finished is None and now - last_write[0] < PROGRESS_WRITE_INTERVAL:
+            return
+        last_write[0] = now
+        
+        update = {
+            "progress": {key: progress[key] for key in ("files_done", "files_total", "chunks_written")},
+            "current_file": os.path.basename(progress["file"]) if progress["file"] else None,
+            "updated_at": datetime.now()
+        }
+        if finished is not None:
+            file_path, error = finished
+            i = positions[file_path]
+            update[f"files.{i}.status"] = FAILED if error else DONE
+            update[f"files.{i}.error"] = error
+        jobs.update_one({"_id": job["_id"]}, {"$set": update})
+    
+    # Errors opening the collection propagate, so the job records the real cause
+    collection = open_user_collection(chroma_client, job["user_id"])
+    
+    stats = index_files(list(positions), collection, job["user_id"], progress=record)
+    
+    errors = dict(stats["errors"])
+    update = {}
+    failures = 0
+    for i, file in enumerate(job["files"]):
+        if file["path"] is None:
+            failures += 1
+        elif file["path"] in errors:
+            failures += 1
+            update[f"files.{i}.status"] = FAILED
+            update[f"files.{i}.error"] = errors[file["path"]]
+        else:
+            # Unchanged files are skipped without a per-file progress event
+            update[f"files.{i}.status"] = DONE
+    
+    update.update({
+        "status": FAILED if job["files"] and failures == len(job["files"]) else DONE,
+        "stats": {key: value for key, value in stats.items() if key != "errors"},
+        "current_file": None,
+        "finished_at": datetime.now(),
+        "updated_at": datetime.now()
+    })
+    jobs.update_one({"_id": job["_id"]}, {"$set": update})
+
+def run_compaction(jobs, job, chroma_client):
+    """Drop chunks of files deleted outside the app and resync BM25"""
+    from database import compact_collection
+    from vector_store import open_user_collection
+    
+    if has_active_jobs(jobs, job["user_id"]):
+        # Chunks being written would look like strays; fail so the next request retries
+        update = {"status": FAILED, "error": "Skipped while documents were being indexed"}
+    else:
+        removed = compact_collection(open_user_collection(chroma_client, job["user_id"]), job["user_id"])
+        update = {"status": DONE, "stats": {"removed": removed}}
+    update.update({"finished_at": datetime.now(), "updated_at": datetime.now()})
+    jobs.update_one({"_id": job["_id"]}, {"$set": update})
+
+def _heartbeat(jobs, job_id, stop):
+    """Keep a running job from looking stale while one long step runs"""
+    while not stop.wait(JOB_HEARTBEAT_SECONDS):
+        try:
+            jobs.update_one({"_id": job_id, "status": RUNNING}, {"$set": {"updated_at": datetime.now()}})
+        except Exception as e:
+            logger.warning("Heartbeat for ingestion job %s failed: %s", job_id, e)
+
+def _run():
+    from resources import get_chroma_client
+    
+    while True:
+        try:
+            jobs = get_jobs_collection()
+            requeue_interrupted_jobs(jobs)
+            
+            job = claim_next_job(jobs)
+            if job is None:
+                _wake.wait(JOB_POLL_SECONDS)
+                _wake.clear()
+                continue
+            
+            stop_heartbeat = threading.Event()
+            threading.Thread(
+                target=_heartbeat, args=(jobs, job["_id"], stop_heartbeat), name="ingest-heartbeat", daemon=True
+            ).start()
+            try:
+                run = run_compaction if job.get("kind") == COMPACT else run_job
+                run(jobs, job, get_chroma_client())
+            except Exception as e:
+                logger.exception("Ingestion job %s failed", job["_id"])
+                jobs.update_one({"_id": job["_id"]}, {"$set": {
+                    "status": FAILED, "error": str(e),
+                    "finished_at": datetime.now(), "updated_at": datetime.now()
+                }})
+            finally:
+                stop_heartbeat.set()
+        except Exception:
+            logger.exception("Ingestion worker error")
+            time.sleep(JOB_POLL_SECONDS)
+
+def start_worker():
+    """Start this process's ingestion worker thread if it is not running"""
+    global _worker
+    with _worker_lock:
+        if _worker is None or not _worker.is_alive():
+            _worker = threading.Thread(target=_run, name="ingest-worker", daemon=True)
+            _worker.start()
\ No newline at end of file
@@ -0,0 +1,259 @@
+import os
+import multiprocessing
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from concurrent.futures.process import BrokenProcessPool
+
+from blob_store import load_parsed, save_parsed
+from chunking import Chunker
+from lexical_index import get_lexical_index
+from database import (
+    ChunkWriter, DEFAULT_BATCH_SIZE, documents_changed, file_content_hash,
+    get_indexed_chunks, is_up_to_date, sync_file_chunks
+)
+
+MAX_WORKERS = int(os.getenv("INGEST_WORKERS", os.cpu_count() or 1))
+# Files above this size are parsed in the ingesting thread and streamed
+# into the collection instead of being returned whole by a pool worker
+PARSE_STREAM_BYTES = int(os.getenv("PARSE_STREAM_BYTES", 20 * 1024 * 1024))
+
+_executor = None
+_start_method = os.getenv("INGEST_START_METHOD")
+
+def set_parse_start_method(method):
+    """Choose how parse workers are started ("fork", "forkserver", "spawn").
+
+    The default is fork: spawned or forkserver workers import __main__,
+    which re-runs the CLI script's top-level prompts, and the CLI parses
+    before it starts any threads of its own. Multithreaded hosts such as
+    the Streamlit app should switch to forkserver, because a forked child
+    inherits locks that other threads may hold at the moment of the fork.
+    INGEST_START_METHOD overrides both.
+    """
+    global _start_method
+    if not os.getenv("INGEST_START_METHOD"):
+        _start_method = method
+
+def _pool_start_method():
+    """Start method for the parse pool, or None to parse in-process.
+
+    Without fork (Windows, unless forkserver or spawn was asked for
+    explicitly) there is no pool: spawned workers would re-run the CLI
+    script, which has no ``__main__`` guard.
+    """
+    methods = multiprocessing.get_all_start_methods()
+    method = _start_method or "fork"
+    if method in methods:
+        return method
+    return "fork" if "fork" in methods else None
+
+def get_parse_executor():
+    """Return the process pool shared by every ingestion in this process"""
+    global _executor
+    if _executor is None:
+        _executor = ProcessPoolExecutor(
+            max_workers=MAX_WORKERS, mp_context=multiprocessing.get_context(_pool_start_method())
+        )
+    return _executor
+
+def _reset_parse_executor():
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=False, cancel_futures=True)
+    _executor = None
+
+def iter_file_chunks(file_path, chunker):
+    """Lazily parse and chunk one file, one segment in memory at a time"""
+    from file_processing import iter_file_content
+    return chunker.iter_chunks(iter_file_content(file_path))
+
+def parse_file(file_path, chunker):
+    """Parse and chunk one file into a list; runs inside a pool worker.
+
+    The whole result is pickled back to the parent, so only files up to
+    PARSE_STREAM_BYTES are sent to the pool; larger ones go through
+    iter_file_chunks instead.
+    """
+    return list(iter_file_chunks(file_path, chunker))
+
+def _streams(file_path):
+    try:
+        return os.path.getsize(file_path) > PARSE_STREAM_BYTES
+    except OSError:
+        return False  # Let the parser report the error
+
+def _iter_parsed(file_paths, chunker, max_in_flight):
+    """Yield ``(file_path, chunks, error)`` as files finish parsing.
+
+    ``chunks`` is a list, except for files over PARSE_STREAM_BYTES: those
+    get a lazy iterator that parses in the caller's thread as it is
+    consumed, while the pool works on the rest. At most ``max_in_flight``
+    pool results are held in memory at once, so a large upload cannot
+    outrun the writer.
+
+    When a worker crashes the pool breaks and takes every in-flight parse
+    with it. Those files are retried one at a time in a fresh pool, so a
+    file only fails for a crash it caused itself. A single file, or any
+    number where no pool can be started safely, is parsed in-process.
+    """
+    streamed = [file_path for file_path in file_paths if _streams(file_path)]
+    pooled = [file_path for file_path in file_paths if file_path not in streamed]
+    
+    if len(pooled) <= 1 or _pool_start_method() is None:
+        for file_path in pooled:
+            try:
+                yield file_path, parse_file(file_path, chunker), None
+            except Exception as e:
+                yield file_path, None, e
+        for file_path in streamed:
+            yield file_path, iter_file_chunks(file_path, chunker), None
+        return
+    
+    pending_paths = deque(pooled)
+    retry_paths = deque()
+    in_flight = {}
+    executor = get_parse_executor()
+    
+    def submit():
+        if not in_flight and retry_paths:
+            file_path = retry_paths.popleft()
+            in_flight[executor.submit(parse_file, file_path, chunker)] = file_path
+            return True
+        while not retry_paths and pending_paths and len(in_flight) < max_in_flight:
+            file_path = pending_paths.popleft()
+            in_flight[executor.submit(parse_file, file_path, chunker)] = file_path
+        return False
+    
+    isolated = submit()
+    # Pool workers keep parsing while the large files stream here
+    for file_path in streamed:
+        yield file_path, iter_file_chunks(file_path, chunker), None
+    
+    while in_flight:
+        done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+        broken = False
+        for future in done:
+            file_path = in_flight.pop(future)
+            try:
+                chunks = future.result()
+            except BrokenProcessPool as e:
+                broken = True
+                if isolated:
+                    yield file_path, None, e
+                else:
+                    retry_paths.append(file_path)
+            except Exception as e:
+                yield file_path, None, e
+            else:
+                yield file_path, chunks, None
+        
+        if broken:
+            # A crashed worker poisons the pool; retry whatever it took down
+            retry_paths.extend(in_flight.values())
+            in_flight.clear()
+            _reset_parse_executor()
+            executor = get_parse_executor()
+        isolated = submit()
+
+def _iter_parsed_cached(to_parse, chunker, max_in_flight):
+    """_iter_parsed, but content parsed before with this chunker is reused.
+
+    Parses are cached by content hash, so the same file uploaded by many
+    users, or under several names, is parsed once.
+    """
+    signature = chunker.signature
+    uncached = []
+    for file_path, (manifest, _) in to_parse.items():
+        chunks = load_parsed(manifest["content_hash"], signature)
+        if chunks is None:
+            uncached.append(file_path)
+        else:
+            yield file_path, chunks, None
+    
+    for file_path, chunks, error in _iter_parsed(uncached, chunker, max_in_flight):
+        # Streamed files are too large to cache and are parsed again next time
+        if error is None and isinstance(chunks, list):
+            try:
+                save_parsed(to_parse[file_path][0]["content_hash"], signature, chunks)
+            except Exception:
+                pass  # Only a cache; the next upload parses again
+        yield file_path, chunks, error
+
+def index_files(file_paths, collection, user_id, max_in_flight=None,
+                batch_size=DEFAULT_BATCH_SIZE, progress=None, chunker=None):
+    """Incrementally index files into a ChromaDB collection.
+
+    Unchanged files (same content hash and chunker settings as recorded in
+    the collection) are skipped without being parsed. The rest are parsed
+    in a process pool, or taken from the parse cache, and written in
+    batches of ``batch_size`` as they complete, so one bad file does not
+    stop the others. ``progress`` is called with a dict of
+    ``files_done``, ``files_total``, ``chunks_written`` and ``file`` after
+    every batch and every finished file; after a finished file it also
+    carries ``finished`` as ``(file_path, error_message_or_None)``.
+    Returns a dict of counters plus ``errors`` as (file_path, message).
+    """
+    stats = {"indexed": 0, "skipped": 0, "empty": 0, "added": 0, "removed": 0, "errors": []}
+    state = {"files_done": 0, "files_total": len(file_paths), "chunks_written": 0, "file": None}
+    
+    def report(chunks_written=0, finished=None):
+        state["chunks_written"] += chunks_written
+        if progress:
+            progress(dict(state, finished=finished))
+    
+    lexical_index = get_lexical_index(collection)
+    writer = ChunkWriter(collection, batch_size=batch_size, on_flush=report,
+                         lexical_index=lexical_index)
+    chunker = chunker or Chunker()
+    
+    to_parse = {}
+    for file_path in file_paths:
+        try:
+            manifest = {
+                "content_hash": file_content_hash(file_path),
+                "chunker": chunker.signature
+            }
+            indexed = get_indexed_chunks(collection, file_path)
+        except Exception as e:
+            stats["errors"].append((file_path, str(e)))
+            state["files_done"] += 1
+            continue
+        if is_up_to_date(indexed, manifest):
+            stats["skipped"] += 1
+            state["files_done"] += 1
+            continue
+        to_parse[file_path] = (manifest, indexed)
+    report()
+    
+    if max_in_flight is None:
+        max_in_flight = MAX_WORKERS * 2
+    
+    for file_path, chunks, error in _iter_parsed_cached(to_parse, chunker, max_in_flight):
+        state["file"] = file_path
+        if error is not None:
+            error = str(error)
+            stats["errors"].append((file_path, error))
+        else:
+            manifest, indexed = to_parse[file_path]
+            try:
+                added, removed, total = sync_file_chunks(
+                    collection, user_id, file_path, manifest, chunks, indexed, writer
+                )
+                stats["added"] += added
+                stats["removed"] += removed
+                stats["indexed" if total else "empty"] += 1
+            except Exception as e:
+                # Drop the partially written file so the next run re-indexes it
+                # instead of trusting a manifest hash that only covers some chunks.
+                writer.discard()
+                collection.delete(where={"source": file_path})
+                lexical_index.remove_where(source=file_path)
+                error = str(e)
+                stats["errors"].append((file_path, error))
+        state["files_done"] += 1
+        report(finished=(file_path, error))
+    
+    if to_parse:
+        documents_changed(collection.name, user_id)
+    
+    return stats
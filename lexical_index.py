@@ -0,0 +1,224 @@
+import os
+import re
+import json
+import sqlite3
+import threading
+
+from cache import TTLCache
+
+LEXICAL_INDEX_DIR = os.getenv("LEXICAL_INDEX_DIR", "./lexical_index")
+BUILD_PAGE_SIZE = int(os.getenv("LEXICAL_BUILD_PAGE_SIZE", 500))
+TOKEN_PATTERN = re.compile(r"\w+")
+
+_indexes = TTLCache(maxsize=64, ttl=3600)
+_indexes_lock = threading.Lock()
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS chunks (
+    rowid INTEGER PRIMARY KEY,
+    id TEXT NOT NULL UNIQUE,
+    source TEXT,
+    document TEXT NOT NULL,
+    metadata TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS chunks_source ON chunks (source);
+CREATE VIRTUAL TABLE IF NOT EXISTS chunks_fts USING fts5 (
+    document, content='chunks', content_rowid='rowid'
+);
+CREATE TRIGGER IF NOT EXISTS chunks_insert AFTER INSERT ON chunks BEGIN
+    INSERT INTO chunks_fts (rowid, document) VALUES (new.rowid, new.document);
+END;
+CREATE TRIGGER IF NOT EXISTS chunks_delete AFTER DELETE ON chunks BEGIN
+    INSERT INTO chunks_fts (chunks_fts, rowid, document) VALUES ('delete', old.rowid, old.document);
+END;
+CREATE TRIGGER IF NOT EXISTS chunks_update AFTER UPDATE OF document ON chunks BEGIN
+    INSERT INTO chunks_fts (chunks_fts, rowid, document) VALUES ('delete', old.rowid, old.document);
+    INSERT INTO chunks_fts (rowid, document) VALUES (new.rowid, new.document);
+END;
+CREATE TABLE IF NOT EXISTS state (key TEXT PRIMARY KEY, value TEXT);
+"""
+# An upsert rather than INSERT OR REPLACE, whose implicit delete would
+# not fire the trigger that keeps chunks_fts in step
+UPSERT = (
+    "INSERT INTO chunks (id, source, document, metadata) VALUES (?, ?, ?, ?) "
+    "ON CONFLICT (id) DO UPDATE SET source = excluded.source, "
+    "document = excluded.document, metadata = excluded.metadata"
+)
+
+def tokenize(text):
+    return TOKEN_PATTERN.findall(text.lower())
+
+class BM25Index:
+    """BM25 index over one collection's chunks, stored in SQLite FTS5.
+    
+    Chunks are stored with their text and metadata so lexical hits can be
+    returned without a round trip to Chroma. Every change is its own
+    small transaction, so nothing is rewritten or re-tokenized as a whole,
+    and the CLI and the app can update the same index concurrently.
+    """
+    
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.RLock()
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._db = sqlite3.connect(path, timeout=60, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.executescript(SCHEMA)
+    
+    def _transaction(self, statements):
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                for sql, rows in statements:
+                    self._db.executemany(sql, rows)
+                self._db.execute("COMMIT")
+            except BaseException:
+                self._db.execute("ROLLBACK")
+                raise
+    
+    def add(self, ids, documents, metadatas):
+        self._transaction([(UPSERT, _rows(ids, documents, metadatas))])
+    
+    def update_metadata(self, ids, metadatas):
+        self._transaction([(
+            "UPDATE chunks SET source = ?, metadata = ? WHERE id = ?",
+            [((metadata or {}).get("source"), json.dumps(metadata or {}), doc_id)
+             for doc_id, metadata in zip(ids, metadatas)]
+        )])
+    
+    def remove(self, ids):
+        self._transaction([("DELETE FROM chunks WHERE id = ?", [(doc_id,) for doc_id in ids])])
+    
+    def remove_where(self, **filters):
+        """Remove chunks whose metadata matches every ``key=value``"""
+        clause, params = _where_clause(filters)
+        self._transaction([(f"DELETE FROM chunks WHERE {clause}", [params])])
+    
+    def clear(self):
+        self._transaction([("DELETE FROM chunks", [()])])
+    
+    def ids(self):
+        """IDs of every indexed chunk"""
+        with self._lock:
+            return {row[0] for row in self._db.execute("SELECT id FROM chunks")}
+    
+    def __len__(self):
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*) FROM chunks").fetchone()[0]
+    
+    def search(self, query, k=10, where=None):
+        """Return up to ``k`` ``(doc_id, document, metadata, score)`` by BM25"""
+        terms = sorted(set(tokenize(query)))
+        if not terms:
+            return []
+        sql = (
+            "SELECT chunks.id, chunks.document, chunks.metadata, -bm25(chunks_fts) "
+            "FROM chunks_fts JOIN chunks ON chunks.rowid = chunks_fts.rowid "
+            "WHERE chunks_fts MATCH ?"
+        )
+        params = [" OR ".join(f'"{term}"' for term in terms)]
+        if where:
+            clause, where_params = _where_clause(where)
+            sql += f" AND {clause}"
+            params += where_params
+        sql += " ORDER BY bm25(chunks_fts) LIMIT ?"
+        with self._lock:
+            rows = self._db.execute(sql, params + [k]).fetchall()
+        return [(doc_id, document, json.loads(metadata), score) for doc_id, document, metadata, score in rows]
+    
+    def build(self, collection, page_size=BUILD_PAGE_SIZE):
+        """Fill the index from the collection's stored chunks, once.
+        
+        Runs page by page in one transaction, so a concurrent builder in
+        another process waits and then finds the index already built.
+        """
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                if self._db.execute("SELECT 1 FROM state WHERE key = 'built'").fetchone() is None:
+                    offset = 0
+                    while True:
+                        page = collection.get(include=["documents", "metadatas"], limit=page_size, offset=offset)
+                        self._db.executemany(UPSERT, _rows(page["ids"], page["documents"], page["metadatas"]))
+                        if len(page["ids"]) < page_size:
+                            break
+                        offset += page_size
+                    self._db.execute("INSERT INTO state (key, value) VALUES ('built', '1')")
+                self._db.execute("COMMIT")
+            except BaseException:
+                self._db.execute("ROLLBACK")
+                raise
+    
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+def _rows(ids, documents, metadatas):
+    return [
+        (doc_id, (metadata or {}).get("source"), document, json.dumps(metadata or {}))
+        for doc_id, document, metadata in zip(ids, documents, metadatas)
+    ]
+
+def _where_clause(filters):
+    clauses, params = [], []
+    for key, value in filters.items():
+        if key == "source":
+            clauses.append("source = ?")
+        else:
+            clauses.append("json_extract(metadata, ?) = ?")
+            params.append(f"$.{key}")
+        params.append(value)
+    return " AND ".join(clauses) or "1", params
+
+def _index_path(collection_name):
+    return os.path.join(LEXICAL_INDEX_DIR, f"{collection_name}.sqlite")
+
+def get_lexical_index(collection):
+    """Return the BM25 index for a collection, building it if needed.
+    
+    A collection that predates its index is indexed from its stored
+    chunks, page by page, the first time it is used. Open indexes are
+    kept in a small pool; reopening one only opens the SQLite file.
+    """
+    path = _index_path(collection.name)
+    with _indexes_lock:
+        index = _indexes.get(path)
+    if index is not None:
+        return index
+    
+    index = BM25Index(path)
+    try:
+        index.build(collection)
+    except Exception:
+        index.close()
+        raise
+    # Indexes from before SQLite were one JSON file; the build replaces them
+    legacy_path = os.path.join(LEXICAL_INDEX_DIR, f"{collection.name}.json")
+    if os.path.exists(legacy_path):
+        os.remove(legacy_path)
+    
+    with _indexes_lock:
+        pooled = _indexes.get(path)
+        if pooled is None:
+            _indexes.set(path, index)
+            return index
+    index.close()  # Another thread opened it meanwhile
+    return pooled
+
+def drop_lexical_index(collection_name):
+    """Empty a collection's index, e.g. when the collection is deleted.
+    
+    The file is kept (and stays marked as built) rather than deleted, so
+    connections other processes hold to it keep seeing the same index.
+    """
+    path = _index_path(collection_name)
+    with _indexes_lock:
+        index = _indexes.get(path)
+    if index is None:
+        if not os.path.exists(path):
+            return
+        index = BM25Index(path)
+        index.clear()
+        index.close()
+    else:
+        index.clear()
@@ -0,0 +1,27 @@
+from resources import get_llm_gateway
+
+CHAT_MODEL = "jamba-large"
+
+def stream_chat(messages, **params):
+    """Yield the assistant's answer in text pieces as the model produces them"""
+    params.setdefault("model", CHAT_MODEL)
+    yield from get_llm_gateway().stream(messages, **params)
+
+def summarize_conversation(previous_summary, messages, max_tokens=200):
+    """Fold ``messages`` into a running conversation summary"""
+    transcript = "\n".join(f"{message['role']}: {message['content']}" for message in messages)
+    prompt = f"""Update the summary of a conversation with the new messages below. Keep names, facts, decisions and open questions. Answer with the summary only.
+
+Current summary:
+{previous_summary or "(none)"}
+
+New messages:
+{transcript}"""
+    
+    answer = get_llm_gateway().complete(
+        [{"role": "user", "content": prompt}],
+        model=CHAT_MODEL,
+        max_tokens=max_tokens,
+        temperature=0.1
+    )
+    return answer.strip()
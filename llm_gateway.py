@@ -0,0 +1,223 @@
+import os
+import json
+import time
+import queue
+import random
+import asyncio
+import threading
+
+import httpx
+
+AI21_API_BASE = os.getenv("AI21_API_BASE", "https://api.ai21.com/studio/v1")
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", 8))
+LLM_TIMEOUT = float(os.getenv("LLM_TIMEOUT", 30))
+LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", 3))
+
+RETRYABLE_STATUS = {408, 429, 500, 502, 503, 504}
+
+class LLMError(Exception):
+    """A completion request failed and will not be retried"""
+
+class _Retryable(Exception):
+    pass
+
+class LLMGateway:
+    """Shared async client for the chat completions endpoint.
+
+    All requests go through one pooled ``httpx.AsyncClient`` running on a
+    private event loop thread, so synchronous callers (Streamlit scripts,
+    the CLI) can use ``complete``/``stream`` while async code awaits
+    ``acomplete``/``astream``. A semaphore caps concurrent upstream calls,
+    each request has an overall deadline covering queueing, retries and
+    every read of a streamed answer, and transient failures are retried
+    with jittered exponential backoff.
+    """
+    
+    def __init__(self, api_key, base_url=AI21_API_BASE, max_concurrency=LLM_MAX_CONCURRENCY,
+                 timeout=LLM_TIMEOUT, max_retries=LLM_MAX_RETRIES, backoff=0.5):
+        self.api_key = api_key
+        self.url = base_url.rstrip("/") + "/chat/completions"
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self._stats = {
+            "requests": 0, "errors": 0, "retries": 0, "in_flight": 0,
+            "queue_time": 0.0, "upstream_time": 0.0, "max_queue_time": 0.0
+        }
+        self._stats_lock = threading.Lock()
+        
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever, name="llm-gateway", daemon=True)
+        self._thread.start()
+        self._semaphore = None
+        self._client = None
+        self._run(self._setup(max_concurrency)).result()
+    
+    async def _setup(self, max_concurrency):
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._client = httpx.AsyncClient(
+            headers={"Authorization": f"Bearer {self.api_key}"},
+            limits=httpx.Limits(max_connections=max_concurrency, max_keepalive_connections=max_concurrency)
+        )
+    
+    def _run(self, coroutine):
+        return asyncio.run_coroutine_threadsafe(coroutine, self._loop)
+    
+    def close(self):
+        self._run(self._client.aclose()).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+    
+    def metrics(self):
+        """Request counts and average time spent queued vs. upstream"""
+        with self._stats_lock:
+            stats = dict(self._stats)
+        done = max(stats["requests"] - stats["in_flight"], 1)
+        stats["avg_queue_time"] = stats["queue_time"] / done
+        stats["avg_upstream_time"] = stats["upstream_time"] / done
+        return stats
+    
+    def _record(self, **changes):
+        with self._stats_lock:
+            for key, value in changes.items():
+                self._stats[key] += value
+            self._stats["max_queue_time"] = max(self._stats["max_queue_time"], changes.get("queue_time", 0.0))
+    
+    # ----- async API -----
+    
+    async def acomplete(self, messages, deadline=None, **params):
+        """Return the full answer text"""
+        parts = []
+        async for delta in self._request(messages, deadline, stream=False, **params):
+            parts.append(delta)
+        return "".join(parts)
+    
+    async def astream(self, messages, deadline=None, **params):
+        """Yield answer text pieces as they arrive"""
+        async for delta in self._request(messages, deadline, stream=True, **params):
+            yield delta
+    
+    async def _request(self, messages, deadline, stream, **params):
+        payload = {"messages": [_as_dict(message) for message in messages], "stream": stream, **params}
+        queued_at = time.monotonic()
+        expires_at = queued_at + (deadline or self.timeout)
+        self._record(requests=1, in_flight=1)
+        
+        try:
+            async with self._semaphore:
+                started_at = time.monotonic()
+                self._record(queue_time=started_at - queued_at)
+                try:
+                    async for delta in self._attempts(payload, stream, expires_at):
+                        yield delta
+                finally:
+                    self._record(upstream_time=time.monotonic() - started_at)
+        except Exception:
+            self._record(errors=1)
+            raise
+        finally:
+            self._record(in_flight=-1)
+    
+    async def _attempts(self, payload, stream, expires_at):
+        attempt = 0
+        while True:
+            remaining = expires_at - time.monotonic()
+            if remaining <= 0:
+                raise LLMError("LLM request deadline exceeded")
+            yielded = False
+            try:
+                async for delta in self._attempt(payload, stream, expires_at):
+                    yielded = True
+                    yield delta
+                return
+            except (_Retryable, httpx.TransportError) as e:
+                # Once text has been handed out a retry would duplicate it
+                if yielded or attempt >= self.max_retries:
+                    raise LLMError(f"LLM request failed: {e}") from e
+            delay = random.uniform(0, self.backoff * 2 ** attempt)
+            if time.monotonic() + delay >= expires_at:
+                raise LLMError("LLM request deadline exceeded")
+            attempt += 1
+            self._record(retries=1)
+            await asyncio.sleep(delay)
+    
+    async def _attempt(self, payload, stream, expires_at):
+        # httpx timeouts apply per read, so every await is also bounded by
+        # the time left until ``expires_at``
+        timeout = httpx.Timeout(expires_at - time.monotonic())
+        if not stream:
+            response = await _before(expires_at, self._client.post(self.url, json=payload, timeout=timeout))
+            _check_status(response.status_code, response.text)
+            data = response.json()
+            yield data["choices"][0]["message"]["content"] or ""
+            return
+        
+        request = self._client.build_request("POST", self.url, json=payload, timeout=timeout)
+        response = await _before(expires_at, self._client.send(request, stream=True))
+        try:
+            if response.status_code >= 400:
+                await _before(expires_at, response.aread())
+                _check_status(response.status_code, response.text)
+            lines = response.aiter_lines()
+            while True:
+                try:
+                    line = await _before(expires_at, lines.__anext__())
+                except StopAsyncIteration:
+                    break
+                if not line.startswith("data:"):
+                    continue
+                data = line[len("data:"):].strip()
+                if data == "[DONE]":
+                    break
+                choices = json.loads(data).get("choices") or []
+                delta = choices[0].get("delta", {}).get("content") if choices else None
+                if delta:
+                    yield delta
+        finally:
+            await response.aclose()
+    
+    # ----- sync wrappers -----
+    
+    def complete(self, messages, deadline=None, **params):
+        return self._run(self.acomplete(messages, deadline, **params)).result()
+    
+    def stream(self, messages, deadline=None, **params):
+        pieces = queue.Queue()
+        
+        async def pump():
+            try:
+                async for delta in self.astream(messages, deadline, **params):
+                    pieces.put(("delta", delta))
+                pieces.put(("done", None))
+            except BaseException as e:
+                pieces.put(("error", e))
+        
+        future = self._run(pump())
+        try:
+            while True:
+                kind, value = pieces.get()
+                if kind == "delta":
+                    yield value
+                elif kind == "error":
+                    raise value
+                else:
+                    return
+        finally:
+            future.cancel()
+
+async def _before(expires_at, awaitable):
+    """Await ``awaitable``, giving up with LLMError at ``expires_at``"""
+    try:
+        return await asyncio.wait_for(awaitable, max(expires_at - time.monotonic(), 0))
+    except asyncio.TimeoutError:
+        raise LLMError("LLM request deadline exceeded") from None
+
+def _as_dict(message):
+    if isinstance(message, dict):
+        return {"role": message["role"], "content": message["content"]}
+    return {"role": message.role, "content": message.content}
+
+def _check_status(status_code, body):
+    if status_code in RETRYABLE_STATUS:
+        raise _Retryable(f"HTTP {status_code}")
+    if status_code >= 400:
+        raise LLMError(f"HTTP {status_code}: {body[:200]}")
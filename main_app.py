@@ -4,12 +4,26 @@ import streamlit as st
 from datetime import datetime
 from auth import register_user, login_user
 from database import (
-    setup_document_collection, process_files_to_collection, 
-    query_documents, list_my_chats, generate_chat_title,
-    get_user_uploads_dir, get_file_paths_from_uploads
+    setup_document_collection, delete_document,
+    query_documents, list_my_chats, load_chat, ensure_chat_indexes, generate_chat_title,
+    get_file_paths_from_uploads, SEARCH_ERROR
 )
 from utils import inject_custom_css, is_valid_email
 from file_processing import read_file_content
+from llm import stream_chat, summarize_conversation
+from context import build_context, new_summary_state, estimate_tokens, PROMPT_TOKEN_BUDGET
+from response_cache import response_cache
+from chat_store import save_new_messages
+from user_ids import ensure_user_indexes, generate_user_id
+from user_profiles import get_profile, remember_mode
+from vector_store import warm_user_collection
+from blob_store import store_uploads_async, release
+from ingestion import set_parse_start_method
+from ingest_jobs import (
+    JOBS_COLLECTION, JOB_POLL_SECONDS, STORING, QUEUED, RUNNING, DONE, FAILED,
+    ensure_job_indexes, create_storing_job, queue_stored_files, list_jobs, has_active_jobs,
+    dismiss_finished_jobs, request_compaction, start_worker
+)
 
 # Load environment variables
 from dotenv import load_dotenv
@@ -139,50 +153,87 @@ st.markdown("""
     </script>
 """, unsafe_allow_html=True)
 
-# Initialize AI21 client
-from ai21 import AI21Client
+# Shared clients, built once per process and reused across reruns
 from ai21.models.chat import ChatMessage
-client = AI21Client(api_key=api_key)
-
-# Initialize MongoDB
-from pymongo import MongoClient
+from resources import get_mongo_client, get_chroma_client
 
 try:
-    mongo_client = MongoClient(os.getenv("MONGO_URI"))
+    mongo_client = get_mongo_client()
     db = mongo_client["intern_data"]
     collection = db["chat_collection"]
     users_collection = db["users_collection"]
+    jobs_collection = db[JOBS_COLLECTION]
+    ensure_chat_indexes(collection)
+    ensure_job_indexes(jobs_collection)
+    ensure_user_indexes(users_collection)
+    # Parse workers must not be forked from this multithreaded server
+    set_parse_start_method("forkserver")
+    # Resumes jobs left queued or interrupted by a restart
+    start_worker()
 except Exception as e:
     st.error(f"MongoDB Connection Error: {e}")
     st.stop()
 
-# ChromaDB Configuration
-CHROMA_API_KEY = os.getenv("CHROMA_API_KEY")
-CHROMA_TENANT = os.getenv("CHROMA_TENANT")
-CHROMA_DB = os.getenv("CHROMA_DB")
-
-# Initialize ChromaDB
-import chromadb
 try:
-    if CHROMA_API_KEY:
-        chroma_client = chromadb.CloudClient(
-            api_key=CHROMA_API_KEY,
-            database=CHROMA_DB
-        )
-    else:
-        chroma_client = chromadb.PersistentClient(path="./chroma_db")
+    chroma_client = get_chroma_client()
 except Exception as e:
     st.error(f"ChromaDB Error: {e}")
     st.stop()
 
-def generate_user_id(users_collection):
-    """Generate a new user ID"""
-    last_user = users_collection.find_one(sort=[("created_at", -1)])
-    if not last_user:
-        return "USR0001"
-    last_id = last_user["user_id"]
-    last_num = int(last_id[3:])
-    return f"USR{last_num+1:04d}"
+LOCAL_PROMPT_TEMPLATE = """Based ONLY on the following document content:
+
+{content}
+
+Answer this question: {question}
+
+If the document doesn't contain the exact answer, say "I don't have information about this in my documents". Do not use any external knowledge."""
+
+JOB_STATUS_ICONS = {STORING: "📥", QUEUED: "⏳", RUNNING: "⚙️", DONE: "✅", FAILED: "❌"}
+
+def show_ingest_jobs(user_id):
+    """Sidebar panel with the user's recent indexing jobs and per-file status"""
+    jobs = list_jobs(jobs_collection, user_id)
+    if not jobs:
+        return
+    
+    st.subheader("Indexing")
+    for job in jobs:
+        icon = JOB_STATUS_ICONS.get(job["status"], "")
+        progress = job.get("progress", {})
+        files_done = progress.get("files_done", 0)
+        files_total = progress.get("files_total", len(job["files"]))
+        
+        if job["status"] in (STORING, QUEUED, RUNNING):
+            text = f"{icon} {files_done}/{files_total} files, {progress.get('chunks_written', 0)} chunks"
+            if job.get("current_file"):
+                text += f" ({job['current_file']})"
+            st.progress(min(files_done / max(files_total, 1), 1.0), text=text)
+        else:
+            st.caption(f"{icon} {files_total} files {job['status']}"
+                       + (f": {job['error']}" if job.get("error") else ""))
+        
+        with st.expander("Files", expanded=job["status"] == RUNNING):
+            for file in job["files"]:
+                line = f"{JOB_STATUS_ICONS.get(file['status'], '')} {file['name']}"
+                if file.get("error"):
+                    line += f" — {file['error']}"
+                st.text(line)
+    
+    if any(job["status"] in (DONE, FAILED) for job in jobs):
+        if st.button("Clear finished", key="dismiss_jobs", use_container_width=True):
+            dismiss_finished_jobs(jobs_collection, user_id)
+            st.rerun()
+
+def poll_ingest_jobs(user_id):
+    """show_ingest_jobs, refreshed every JOB_POLL_SECONDS while jobs are active"""
+    show_ingest_jobs(user_id)
+    if not has_active_jobs(jobs_collection, user_id):
+        # Rerun the page once so it renders without the poller (and shows the new files)
+        st.rerun()
+
+# Poll the job table without rerunning the whole page, where supported
+if hasattr(st, "fragment"):
+    poll_ingest_jobs = st.fragment(run_every=JOB_POLL_SECONDS)(poll_ingest_jobs)
 
 def main():
     inject_custom_css()
@@ -197,10 +248,16 @@ def main():
         st.session_state.doc_collection = None
     if "current_chat" not in st.session_state:
         st.session_state.current_chat = []
+    if "chat_id" not in st.session_state:
+        st.session_state.chat_id = None
+    if "saved_count" not in st.session_state:
+        st.session_state.saved_count = 0
+    if "context_summary" not in st.session_state:
+        st.session_state.context_summary = new_summary_state()
     if "chat_title" not in st.session_state:
         st.session_state.chat_title = "New Chat"
-    if "show_more_chats" not in st.session_state:
-        st.session_state.show_more_chats = False
+    if "history_pages" not in st.session_state:
+        st.session_state.history_pages = 1
     if "file_uploader_key" not in st.session_state:
         st.session_state.file_uploader_key = 0
     
@@ -221,6 +278,10 @@ def main():
             if user_id:
                 st.session_state.user_id = user_id
                 st.session_state.is_new = is_new
+                # Open the document collection ahead of time for local-mode users
+                profile = get_profile(users_collection, user_id)
+                if profile and profile.get("last_mode") == "local":
+                    warm_user_collection(chroma_client, user_id)
                 st.rerun()
         
         with auth_tab2:
@@ -243,7 +304,7 @@ def main():
         """, unsafe_allow_html=True)
         
         # Display user info
-        user_info = users_collection.find_one({"user_id": st.session_state.user_id})
+        user_info = get_profile(users_collection, st.session_state.user_id)
         if user_info:
             st.markdown(f'<div class="user-info">', unsafe_allow_html=True)
             st.write(f"👤 **{user_info['username']}**")
@@ -252,6 +313,9 @@ def main():
         
         if st.button("➕ New Chat", use_container_width=True, type="primary"):
             st.session_state.current_chat = []
+            st.session_state.chat_id = None
+            st.session_state.context_summary = new_summary_state()
+            st.session_state.saved_count = 0
             st.session_state.chat_title = "New Chat"
             st.rerun()
         
@@ -262,16 +326,25 @@ def main():
             if st.button("🌍 Global", use_container_width=True, 
                         type="primary" if st.session_state.mode == "global" else "secondary"):
                 st.session_state.mode = "global"
+                remember_mode(users_collection, st.session_state.user_id, "global")
                 st.rerun()
         with col2:
             if st.button("📁 Local", use_container_width=True, 
                         type="primary" if st.session_state.mode == "local" else "secondary"):
                 st.session_state.mode = "local"
+                remember_mode(users_collection, st.session_state.user_id, "local")
 
                 if st.session_state.doc_collection is None:
                     st.session_state.doc_collection = setup_document_collection(
                         chroma_client, st.session_state.user_id
                     )
+                    # Chunks of files deleted outside the app are dropped by the
+                    # ingest worker, at most once per COMPACTION_INTERVAL_SECONDS
+                    if st.session_state.doc_collection:
+                        try:
+                            request_compaction(jobs_collection, st.session_state.user_id)
+                        except Exception as e:
+                            st.warning(f"Could not schedule document compaction: {e}")
                 st.rerun()
         
         # Document Management for Local Mode
@@ -287,34 +360,28 @@ def main():
             )
             
             if uploaded_files:
-                user_uploads_dir = get_user_uploads_dir(st.session_state.user_id)
-                file_paths = []
-                
-                for uploaded_file in uploaded_files:
-                    # Save uploaded file to user-specific directory
-                    file_path = user_uploads_dir / uploaded_file.name
-                    
-                    # Handle duplicate files
-                    counter = 1
-                    while file_path.exists():
-                        name, ext = os.path.splitext(uploaded_file.name)
-                        file_path = user_uploads_dir / f"{name}_{counter}{ext}"
-                        counter += 1
-                    
-                    with open(file_path, "wb") as f:
-                        f.write(uploaded_file.getbuffer())
-                    
-                    file_paths.append(str(file_path))
-                
-                # Process files to collection
+                # Store (deduplicated by content) and index in the background
+                # so chatting is not blocked
                 if st.session_state.doc_collection:
-                    st.session_state.doc_collection = process_files_to_collection(
-                        file_paths, st.session_state.doc_collection, st.session_state.user_id
+                    user_id = st.session_state.user_id
+                    # The job exists before the handoff, so store errors land on it
+                    job_id = create_storing_job(jobs_collection, user_id, [uploaded_file.name for uploaded_file in uploaded_files])
+                    store_uploads_async(
+                        user_id,
+                        [(uploaded_file.name, uploaded_file) for uploaded_file in uploaded_files],
+                        on_stored=lambda results: queue_stored_files(jobs_collection, job_id, results)
                     )
                     st.session_state.file_uploader_key += 1  # Reset uploader
+                    st.rerun()
                 else:
                     st.error("Document collection not initialized!")
             
+            # Only poll Mongo while something is storing, queued or running
+            if hasattr(st, "fragment") and has_active_jobs(jobs_collection, st.session_state.user_id):
+                poll_ingest_jobs(st.session_state.user_id)
+            else:
+                show_ingest_jobs(st.session_state.user_id)
+            
             # Show uploaded files
             existing_files = get_file_paths_from_uploads(st.session_state.user_id)
             if existing_files:
@@ -331,7 +398,12 @@ def main():
                     with col3:
                         if st.button("❌", key=f"delete_{file_name}"):
                             try:
-                                os.remove(file_path)
+                                if st.session_state.doc_collection:
+                                    delete_document(
+                                        st.session_state.doc_collection, st.session_state.user_id, file_path
+                                    )
+                                else:
+                                    release(st.session_state.user_id, file_path)
                                 st.success(f"Deleted {file_name}")
                                 time.sleep(1)
                                 st.rerun()
@@ -340,13 +412,16 @@ def main():
         
         # Chat History
         st.subheader("Chat History")
-        chats = list_my_chats(collection, st.session_state.user_id)
+        # Fetch one page of 5 titles per "Show More" click, following cursors
+        chats, next_cursor = list_my_chats(collection, st.session_state.user_id)
+        for _ in range(st.session_state.history_pages - 1):
+            if next_cursor is None:
+                break
+            page, next_cursor = list_my_chats(collection, st.session_state.user_id, before=next_cursor)
+            chats.extend(page)
         
         if chats:
-            # Limit to 5 chats unless show more is enabled
-            display_chats = chats if st.session_state.show_more_chats or len(chats) <= 5 else chats[:5]
-            
-            for chat in display_chats:
+            for chat in chats:
                 chat_id = str(chat["_id"])
                 title = chat.get("title", "Untitled")
                 timestamp = chat.get("timestamp", datetime.now())
@@ -359,7 +434,11 @@ def main():
                 with chat_col1:
                     
                     if st.button(f"{mode_emoji} {title} - {time_str}", key=f"load_{chat_id}", use_container_width=True):
-                        st.session_state.current_chat = chat.get("chat", [])
+                        opened = load_chat(collection, chat["_id"], st.session_state.user_id) or {}
+                        st.session_state.current_chat = opened.get("chat", [])
+                        st.session_state.chat_id = chat["_id"]
+                        st.session_state.context_summary = new_summary_state()
+                        st.session_state.saved_count = len(st.session_state.current_chat)
                         st.session_state.chat_title = title
                         st.rerun()
                 
@@ -367,20 +446,25 @@ def main():
                     
                     if st.button("❌", key=f"delete_{chat_id}", help="Delete this chat", use_container_width=True):
                         collection.delete_one({"_id": chat["_id"]})
+                        if st.session_state.chat_id == chat["_id"]:
+                            st.session_state.current_chat = []
+                            st.session_state.chat_id = None
+                            st.session_state.context_summary = new_summary_state()
+                            st.session_state.saved_count = 0
+                            st.session_state.chat_title = "New Chat"
                         st.success("Chat deleted!")
                         time.sleep(1)
                         st.rerun()
             
-            # Show more/less button
-            if len(chats) > 5:
-                if st.session_state.show_more_chats:
-                    if st.button("Show Less", use_container_width=True):
-                        st.session_state.show_more_chats = False
-                        st.rerun()
-                else:
-                    if st.button("Show More", use_container_width=True):
-                        st.session_state.show_more_chats = True
-                        st.rerun()
+            # Show more/less buttons
+            if next_cursor is not None:
+                if st.button("Show More", use_container_width=True):
+                    st.session_state.history_pages += 1
+                    st.rerun()
+            if st.session_state.history_pages > 1:
+                if st.button("Show Less", use_container_width=True):
+                    st.session_state.history_pages = 1
+                    st.rerun()
         else:
             st.info("No chat history yet. Start a new conversation!")
         
@@ -391,8 +475,11 @@ def main():
             st.session_state.mode = "global"
             st.session_state.doc_collection = None
             st.session_state.current_chat = []
+            st.session_state.chat_id = None
+            st.session_state.context_summary = new_summary_state()
+            st.session_state.saved_count = 0
             st.session_state.chat_title = "New Chat"
-            st.session_state.show_more_chats = False
+            st.session_state.history_pages = 1
             st.rerun()
     
     # Main chat area
@@ -423,26 +510,44 @@ def main():
         
         if st.session_state.mode == "local" and st.session_state.doc_collection:
         
+            # Whatever the instructions and question leave of the prompt budget goes to documents
+            document_budget = PROMPT_TOKEN_BUDGET - estimate_tokens(
+                LOCAL_PROMPT_TEMPLATE.format(content="", question=user_input)
+            )
             with st.spinner("Searching in your documents..."):
-                relevant_doc_content = query_documents(user_input, st.session_state.doc_collection)
+                relevant_doc_content = query_documents(
+                    user_input, st.session_state.doc_collection, token_budget=max(document_budget, 0)
+                )
+            
+            # Answers depend on the retrieved text, so it is part of the cache key;
+            # an answer given without it (failed search) must not be cached
+            cache_mode, cache_context = "local", relevant_doc_content
+            cacheable = relevant_doc_content != SEARCH_ERROR
             
             if relevant_doc_content and "No relevant information" not in relevant_doc_content:
-                context_prompt = f"""Based ONLY on the following document content:
-
-{relevant_doc_content}
-
-Answer this question: {user_input}
-
-If the document doesn't contain the exact answer, say "I don't have information about this in my documents". Do not use any external knowledge."""
+                context_prompt = LOCAL_PROMPT_TEMPLATE.format(content=relevant_doc_content, question=user_input)
                 
                 messages = [ChatMessage(role="user", content=context_prompt)]
             else:
                 messages = [ChatMessage(role="user", content=user_input)]
         else:
             
-            messages = []
-            for msg in st.session_state.current_chat:
-                messages.append(ChatMessage(role=msg["role"], content=msg["content"]))
+            # Recent turns within the token budget, older ones as a running summary
+            context = build_context(
+                st.session_state.current_chat,
+                st.session_state.context_summary,
+                summarize_conversation
+            )
+            messages = [ChatMessage(role=msg["role"], content=msg["content"]) for msg in context]
+            # Later global turns depend on the conversation so far; only cache openers
+            cache_mode, cache_context = "global", ""
+            cacheable = len(st.session_state.current_chat) == 1
+        
+        cached_answer = question_embedding = None
+        if cacheable:
+            cached_answer, question_embedding = response_cache.lookup(
+                st.session_state.user_id, user_input, cache_mode, cache_context
+            )
         
         with chat_container:
             typing_placeholder = st.empty()
@@ -451,41 +556,55 @@ If the document doesn't contain the exact answer, say "I don't have information
                 unsafe_allow_html=True
             )
         
+        answer = ""
         try:
             
-            response = client.chat.completions.create(
-                messages=messages,
-                model="jamba-large",
-                max_tokens=250,
-                temperature=0.1 if st.session_state.mode == "local" else 0.3,
-                top_p=0.9
-            )
-            
-            answer = response.choices[0].message.content
-            
-            typing_placeholder.empty()
-            st.markdown(f'<div class="chat-bubble-assistant">🤖 {answer}</div>', unsafe_allow_html=True)
-            
-        
-            st.session_state.current_chat.append({"role": "assistant", "content": answer})
-            
+            if cached_answer is not None:
+                answer = cached_answer
+            else:
+                for delta in stream_chat(
+                    messages,
+                    max_tokens=250,
+                    temperature=0.1 if st.session_state.mode == "local" else 0.3,
+                    top_p=0.9
+                ):
+                    answer += delta
+                    typing_placeholder.markdown(f'<div class="chat-bubble-assistant">🤖 {answer}▌</div>', unsafe_allow_html=True)
+                
+                if cacheable and answer:
+                    response_cache.store(
+                        st.session_state.user_id, user_input, cache_mode, cache_context,
+                        answer, embedding=question_embedding
+                    )
             
-            if len(st.session_state.current_chat) == 2:  
-                collection.insert_one({
-                    "user_id": st.session_state.user_id,
-                    "title": st.session_state.chat_title,
-                    "chat": st.session_state.current_chat,
-                    "timestamp": datetime.now(),
-                    "mode": st.session_state.mode
-                })
+            typing_placeholder.markdown(f'<div class="chat-bubble-assistant">🤖 {answer}</div>', unsafe_allow_html=True)
         
         except Exception as e:
-            typing_placeholder.empty()
             st.error(f"AI API error: {e}")
-            if st.session_state.mode == "local" and 'relevant_doc_content' in locals() and relevant_doc_content and "No relevant information" not in relevant_doc_content:
-                fallback_msg = f"Here's what I found in your documents:\n\n{relevant_doc_content[:1000]}{'...' if len(relevant_doc_content) > 1000 else ''}"
-                st.markdown(f'<div class="chat-bubble-assistant">🤖 {fallback_msg}</div>', unsafe_allow_html=True)
-                st.session_state.current_chat.append({"role": "assistant", "content": fallback_msg})
+            if answer:
+                # Keep whatever streamed before the failure
+                typing_placeholder.markdown(f'<div class="chat-bubble-assistant">🤖 {answer}</div>', unsafe_allow_html=True)
+            else:
+                typing_placeholder.empty()
+                if st.session_state.mode == "local" and 'relevant_doc_content' in locals() and relevant_doc_content and "No relevant information" not in relevant_doc_content:
+                    fallback_msg = f"Here's what I found in your documents:\n\n{relevant_doc_content[:1000]}{'...' if len(relevant_doc_content) > 1000 else ''}"
+                    st.markdown(f'<div class="chat-bubble-assistant">🤖 {fallback_msg}</div>', unsafe_allow_html=True)
+                    st.session_state.current_chat.append({"role": "assistant", "content": fallback_msg})
+        
+        if answer:
+            st.session_state.current_chat.append({"role": "assistant", "content": answer})
+        
+        # Queue only this turn's messages; the write happens off the script thread
+        if st.session_state.current_chat[-1]["role"] == "assistant":
+            st.session_state.chat_id, st.session_state.saved_count = save_new_messages(
+                collection,
+                st.session_state.chat_id,
+                st.session_state.user_id,
+                st.session_state.chat_title,
+                st.session_state.mode,
+                st.session_state.current_chat,
+                st.session_state.saved_count
+            )
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
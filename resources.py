@@ -0,0 +1,89 @@
+import os
+import time
+import logging
+import threading
+
+HEALTH_CHECK_INTERVAL = int(os.getenv("HEALTH_CHECK_INTERVAL", 30))
+
+logger = logging.getLogger(__name__)
+
+_resources = {}
+_lock = threading.Lock()
+
+def get_resource(name, factory, health_check=None):
+    """Return the process-wide instance of ``name``, creating it on first use.
+
+    Streamlit re-runs the app script on every interaction but keeps imported
+    modules, so clients registered here survive reruns and are shared by all
+    sessions. ``health_check`` runs at most every HEALTH_CHECK_INTERVAL
+    seconds, in the caller that finds it due and outside the registry lock,
+    so a slow check never stalls other callers. If it raises, the next call
+    builds a fresh instance; the old one is left to threads still using it.
+    """
+    with _lock:
+        entry = _resources.get(name)
+        now = time.monotonic()
+        if entry is None:
+            entry = {"resource": factory(), "checked_at": now}
+            _resources[name] = entry
+            return entry["resource"]
+        
+        due = health_check is not None and now - entry["checked_at"] >= HEALTH_CHECK_INTERVAL
+        if due:
+            # Claim the check so concurrent callers keep using the instance
+            entry["checked_at"] = now
+    
+    if due:
+        try:
+            health_check(entry["resource"])
+        except Exception as e:
+            logger.warning("Health check of %s failed, rebuilding it: %s", name, e)
+            with _lock:
+                if _resources.get(name) is entry:
+                    del _resources[name]
+    return entry["resource"]
+
+def drop_resource(name, close=None):
+    """Close and forget a resource so the next get_resource rebuilds it"""
+    with _lock:
+        entry = _resources.pop(name, None)
+    if entry is not None:
+        _close_quietly(entry["resource"], close)
+
+def _close_quietly(resource, close):
+    try:
+        if close is not None:
+            close(resource)
+    except Exception:
+        pass
+
+def get_llm_gateway():
+    from llm_gateway import LLMGateway
+    return get_resource("llm_gateway", lambda: LLMGateway(api_key=os.getenv("API_KEY")))
+
+def get_embedding_function():
+    from embeddings import CachedEmbeddingFunction
+    return get_resource("embedding_function", CachedEmbeddingFunction)
+
+def get_mongo_client():
+    from pymongo import MongoClient
+    # No health check: MongoClient reconnects on its own, and closing a
+    # client other threads are using would break their operations
+    return get_resource("mongo", lambda: MongoClient(os.getenv("MONGO_URI")))
+
+def get_chroma_client():
+    import chromadb
+    
+    def create():
+        if os.getenv("CHROMA_API_KEY"):
+            return chromadb.CloudClient(
+                api_key=os.getenv("CHROMA_API_KEY"),
+                database=os.getenv("CHROMA_DB")
+            )
+        return chromadb.PersistentClient(path="./chroma_db")
+    
+    return get_resource(
+        "chroma",
+        create,
+        health_check=lambda client: client.heartbeat()
+    )
@@ -0,0 +1,109 @@
+import os
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+RESPONSE_CACHE_THRESHOLD = float(os.getenv("RESPONSE_CACHE_THRESHOLD", 0.95))
+RESPONSE_CACHE_TTL = int(os.getenv("RESPONSE_CACHE_TTL", 24 * 3600))
+RESPONSE_CACHE_PER_USER = int(os.getenv("RESPONSE_CACHE_PER_USER", 200))
+RESPONSE_CACHE_MAX_USERS = int(os.getenv("RESPONSE_CACHE_MAX_USERS", 1000))
+
+def _default_embed(texts):
+    from resources import get_embedding_function
+    return get_embedding_function().embed(texts)
+
+class SemanticCache:
+    """Per-user cache of answers, looked up by question-embedding similarity.
+
+    An entry only matches questions asked in the same mode with the same
+    context (the retrieved document content, hashed), and whose embedding
+    has cosine similarity of at least ``threshold`` with the stored one.
+    Each user keeps at most ``per_user`` entries, entries expire after
+    ``ttl`` seconds, and the least recently active users are dropped past
+    ``max_users``.
+    """
+    
+    def __init__(self, embed=_default_embed, threshold=RESPONSE_CACHE_THRESHOLD,
+                 ttl=RESPONSE_CACHE_TTL, per_user=RESPONSE_CACHE_PER_USER,
+                 max_users=RESPONSE_CACHE_MAX_USERS):
+        self.embed = embed
+        self.threshold = threshold
+        self.ttl = ttl
+        self.per_user = per_user
+        self.max_users = max_users
+        self._users = OrderedDict()
+        self._lock = threading.Lock()
+    
+    def embed_question(self, question):
+        vector = np.asarray(self.embed([question])[0], dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+    
+    def lookup(self, user_id, question, mode, context="", embedding=None):
+        """Return ``(answer or None, question_embedding)``.
+
+        Pass the embedding back to ``store`` on a miss to avoid computing
+        it twice. Embedding failures count as a miss.
+        """
+        try:
+            if embedding is None:
+                embedding = self.embed_question(question)
+        except Exception:
+            return None, None
+        
+        key = (mode, _context_key(context))
+        now = time.monotonic()
+        with self._lock:
+            entries = self._users.get(user_id)
+            if not entries:
+                return None, embedding
+            self._users.move_to_end(user_id)
+            
+            live = [entry for entry in entries if entry["expires_at"] > now]
+            if len(live) != len(entries):
+                entries[:] = live
+            candidates = [entry for entry in live if entry["key"] == key]
+            if not candidates:
+                return None, embedding
+            
+            scores = np.stack([entry["embedding"] for entry in candidates]) @ embedding
+            best = int(np.argmax(scores))
+            if scores[best] >= self.threshold:
+                return candidates[best]["answer"], embedding
+        return None, embedding
+    
+    def store(self, user_id, question, mode, context, answer, embedding=None):
+        if embedding is None:
+            try:
+                embedding = self.embed_question(question)
+            except Exception:
+                return
+        
+        with self._lock:
+            entries = self._users.setdefault(user_id, [])
+            self._users.move_to_end(user_id)
+            entries.append({
+                "key": (mode, _context_key(context)),
+                "embedding": embedding,
+                "answer": answer,
+                "expires_at": time.monotonic() + self.ttl
+            })
+            if len(entries) > self.per_user:
+                del entries[:len(entries) - self.per_user]
+            while len(self._users) > self.max_users:
+                self._users.popitem(last=False)
+    
+    def invalidate_user(self, user_id, mode="local"):
+        """Drop a user's answers for ``mode`` (all modes when None)"""
+        with self._lock:
+            entries = self._users.get(user_id)
+            if entries:
+                entries[:] = [entry for entry in entries if mode is not None and entry["key"][0] != mode]
+
+def _context_key(context):
+    return hashlib.sha256(context.encode("utf-8")).hexdigest() if context else ""
+
+response_cache = SemanticCache()
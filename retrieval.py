@@ -0,0 +1,179 @@
+import os
+
+from context import estimate_tokens
+from lexical_index import tokenize
+
+RRF_K = 60
+RERANK_CANDIDATES = int(os.getenv("RERANK_CANDIDATES", 30))
+RETRIEVAL_TOKEN_BUDGET = int(os.getenv("RETRIEVAL_TOKEN_BUDGET", 1000))
+RANK_PRIOR_WEIGHT = 0.25
+NEAR_DUPLICATE_THRESHOLD = float(os.getenv("NEAR_DUPLICATE_THRESHOLD", 0.8))
+SHINGLE_SIZE = 3
+MAX_MERGE_OVERLAP = 400
+MIN_MERGE_OVERLAP = 20
+
+STOPWORDS = frozenset("""
+a an and are as at be by can do does for from how i in is it me my of on or
+so that the this to was what when where which who why will with you your
+""".split())
+
+def reciprocal_rank_fusion(rankings, k=RRF_K):
+    """Fuse several ranked lists of IDs; returns IDs best first.
+
+    Each ID scores ``sum(1 / (k + rank))`` over the lists it appears in,
+    so items ranked well by either retriever rise without needing the
+    retrievers' scores to be comparable.
+    """
+    scores = {}
+    for ranking in rankings:
+        for rank, item_id in enumerate(ranking, start=1):
+            scores[item_id] = scores.get(item_id, 0.0) + 1.0 / (k + rank)
+    return sorted(scores, key=lambda item_id: scores[item_id], reverse=True)
+
+def query_terms(question):
+    """Distinct content words of a question"""
+    terms = set(tokenize(question)) - STOPWORDS
+    return terms or set(tokenize(question))
+
+def rerank(question, candidates):
+    """Reorder fused ``(id, document, metadata)`` candidates, best first.
+
+    The score is the share of the question's content words found in the
+    chunk, plus a small prior for the candidate's fused rank so purely
+    semantic matches with no shared words are not dropped outright.
+    """
+    terms = query_terms(question)
+    total = len(candidates)
+    scored = []
+    for rank, candidate in enumerate(candidates):
+        coverage = len(terms & set(tokenize(candidate[1]))) / len(terms) if terms else 0.0
+        prior = RANK_PRIOR_WEIGHT * (1 - rank / total)
+        scored.append((coverage + prior, -rank, candidate))
+    scored.sort(key=lambda item: item[:2], reverse=True)
+    return [candidate for _, _, candidate in scored]
+
+def pack_to_budget(candidates, budget=RETRIEVAL_TOKEN_BUDGET, limit=None):
+    """Take candidates in order while their documents fit in ``budget`` tokens.
+
+    Candidates that would overflow are skipped so a smaller one further
+    down can still fit. If nothing fits, the best candidate is returned
+    alone rather than an empty context.
+    """
+    packed = []
+    used = 0
+    for candidate in candidates:
+        if limit is not None and len(packed) >= limit:
+            break
+        cost = estimate_tokens(candidate[1])
+        if used + cost > budget:
+            continue
+        packed.append(candidate)
+        used += cost
+    if not packed and candidates and limit != 0:
+        packed.append(candidates[0])
+    return packed
+
+
+def _shingles(text):
+    words = tokenize(text)
+    if len(words) < SHINGLE_SIZE:
+        return {tuple(words)}
+    return {tuple(words[i:i + SHINGLE_SIZE]) for i in range(len(words) - SHINGLE_SIZE + 1)}
+
+def drop_near_duplicates(candidates, threshold=NEAR_DUPLICATE_THRESHOLD):
+    """Drop candidates whose word shingles mostly repeat a better-ranked one.
+
+    Two chunks are near-duplicates when the Jaccard similarity of their
+    word 3-grams reaches ``threshold``, which catches the same passage
+    indexed from two copies of a file or by two chunker settings.
+    """
+    kept = []
+    kept_shingles = []
+    for candidate in candidates:
+        shingles = _shingles(candidate[1])
+        if any(len(shingles & other) / len(shingles | other) >= threshold
+               for other in kept_shingles):
+            continue
+        kept.append(candidate)
+        kept_shingles.append(shingles)
+    return kept
+
+def _chunk_overlap(metadata):
+    """Overlap recorded in a chunk's ``unit:size:overlap`` chunker signature"""
+    try:
+        return int((metadata.get("chunker") or "").split(":")[2])
+    except (IndexError, ValueError):
+        return 0
+
+def _join_overlapping(first, second, overlap):
+    """Concatenate two consecutive chunks, dropping the text they share.
+
+    The chunker repeats whole pieces (joined by spaces) at the start of
+    the next chunk, so only a shared run of at least MIN_MERGE_OVERLAP
+    characters that starts and ends on a word boundary is stripped, and
+    only when the chunks were written with overlap at all.
+    """
+    if overlap > 0:
+        for size in range(min(len(first), len(second), MAX_MERGE_OVERLAP), MIN_MERGE_OVERLAP - 1, -1):
+            whole_in_first = size == len(first) or first[-size - 1] == " "
+            whole_in_second = size == len(second) or second[size] == " "
+            if whole_in_first and whole_in_second and first.endswith(second[:size]):
+                return first + second[size:]
+    return first + "\n" + second
+
+def merge_adjacent(candidates):
+    """Merge candidates that are consecutive chunks of the same file.
+
+    Runs of neighbouring ``chunk_index`` values from one source become a
+    single candidate in reading order, placed where the best-ranked chunk
+    of the run was. Chunk overlap is not repeated.
+    """
+    by_position = {}
+    for rank, (chunk_id, document, metadata) in enumerate(candidates):
+        index = metadata.get("chunk_index")
+        if index is not None:
+            by_position.setdefault((metadata.get("source"), index), rank)
+    
+    merged = []
+    consumed = set()
+    for rank, (chunk_id, document, metadata) in enumerate(candidates):
+        if rank in consumed:
+            continue
+        index = metadata.get("chunk_index")
+        if index is None or by_position[(metadata.get("source"), index)] != rank:
+            merged.append((chunk_id, document, metadata))
+            continue
+        
+        source = metadata.get("source")
+        start = index
+        while (source, start - 1) in by_position and by_position[(source, start - 1)] not in consumed:
+            start -= 1
+        end = index
+        while (source, end + 1) in by_position and by_position[(source, end + 1)] not in consumed:
+            end += 1
+        
+        run = [candidates[by_position[(source, i)]] for i in range(start, end + 1)]
+        consumed.update(by_position[(source, i)] for i in range(start, end + 1))
+        text = run[0][1]
+        for _, next_document, next_metadata in run[1:]:
+            text = _join_overlapping(text, next_document, _chunk_overlap(next_metadata))
+        merged.append((run[0][0], text, run[0][2]))
+    return merged
+
+def build_document_context(candidates, token_budget=RETRIEVAL_TOKEN_BUDGET):
+    """Format retrieved chunks as prompt context within ``token_budget``.
+
+    Near-duplicates are dropped and neighbouring chunks merged before
+    formatting; blocks that would push the context over budget are left
+    out, except that the best block is always included.
+    """
+    blocks = []
+    used = 0
+    for _, document, metadata in merge_adjacent(drop_near_duplicates(candidates)):
+        block = f" Source: {metadata.get('filename', 'Unknown')}\nContent: {document}\n"
+        cost = estimate_tokens(block)
+        if blocks and used + cost > token_budget:
+            continue
+        blocks.append(block)
+        used += cost
+    return "\n\n".join(blocks)
@@ -1,18 +1,25 @@
 import os
 import re
 from datetime import datetime
-from ai21 import AI21Client
 from ai21.models.chat import ChatMessage
 from dotenv import load_dotenv
 from pymongo import MongoClient
 import chromadb
-import uuid
-import PyPDF2
-import docx
-import json
-import shutil
 from pathlib import Path
-import openpyxl  
+from ingestion import index_files
+from database import (
+    search_documents, ensure_chat_indexes, load_chat, clear_documents, compact_collection,
+    list_my_chats as list_chat_summaries
+)
+from llm import stream_chat, summarize_conversation
+from context import build_context, new_summary_state
+from retrieval import build_document_context
+from vector_store import open_user_collection
+from ingest_jobs import JOBS_COLLECTION, has_active_jobs
+from blob_store import store_file
+from chat_store import save_new_messages, flush as flush_chat_writes
+from user_ids import ensure_user_indexes, insert_user
+from user_profiles import find_login_profile
 
 load_dotenv()
 api_key = os.getenv("API_KEY")
@@ -21,13 +28,13 @@ if not api_key:
     print(" Error: API_KEY not found.")
     exit()
 
-client = AI21Client(api_key=api_key)
-
 try:
     mongo_client = MongoClient(os.getenv("MONGO_URI"))
     db = mongo_client["intern_data"]
     collection = db["chat_collection"]
     users_collection = db["users_collection"]
+    ensure_chat_indexes(collection)
+    ensure_user_indexes(users_collection)
 except Exception as e:
     print(" MongoDB Connection Error:", e)
     exit()
@@ -65,14 +72,6 @@ def get_user_uploads_dir(user_id):
     user_dir.mkdir(parents=True, exist_ok=True)
     return user_dir
 
-def generate_user_id():
-    last_user = users_collection.find_one(sort=[("created_at", -1)])
-    if not last_user:
-        return "USR0001"
-    last_id = last_user["user_id"]
-    last_num = int(last_id[3:])
-    return f"USR{last_num+1:04d}"
-
 def is_valid_email(email):
     return re.match(r"^[\w\.-]+@[\w\.-]+\.\w+$", email)
 
@@ -96,13 +95,10 @@ def register_user():
                 continue
         break
 
-    user_id = generate_user_id()
-    users_collection.insert_one({
-        "user_id": user_id,
-        "username": username,
-        "email": email,
-        "created_at": datetime.now()
-    })
+    user_id = insert_user(users_collection, username, email)
+    if user_id is None:
+        print(" Email exists. Please login.")
+        return login_user()
     
     # Create user-specific upload directory
     user_uploads_dir = get_user_uploads_dir(user_id)
@@ -121,7 +117,7 @@ def login_user():
             else:
                 return None, None
 
-        user = users_collection.find_one({"email": email, "user_id": user_id_input})
+        user = find_login_profile(users_collection, email, user_id_input)
         if not user:
             print(" Not found. Try again.")
             retry = input("Try again? (y/n): ").strip().lower()
@@ -160,7 +156,6 @@ def upload_files(user_id):
     print("Press Enter twice to finish")
     
     uploaded_files = []
-    user_uploads_dir = get_user_uploads_dir(user_id)
     
     while True:
         file_path = input("\nEnter file path: ").strip()
@@ -187,75 +182,21 @@ def upload_files(user_id):
             print(f"  Unsupported file type: {file_ext}")
             continue
             
-        # Copy file to user-specific uploads directory
+        # Store by content; a file this user already uploaded is reused
         filename = os.path.basename(file_path)
-        dest_path = user_uploads_dir / filename
-        
-        # Handle duplicate files
-        counter = 1
-        while dest_path.exists():
-            name, ext = os.path.splitext(filename)
-            dest_path = user_uploads_dir / f"{name}_{counter}{ext}"
-            counter += 1
-            
         try:
-            shutil.copy2(file_path, dest_path)
-            uploaded_files.append(str(dest_path))
-            print(f"  Uploaded: {filename}")
+            dest_path, is_new = store_file(user_id, file_path)
+            uploaded_files.append(dest_path)
+            if is_new:
+                print(f"  Uploaded: {filename}")
+            else:
+                print(f"  Already uploaded as {os.path.basename(dest_path)}")
             
         except Exception as e:
             print(f"  Error uploading {filename}: {e}")
     
     return uploaded_files
 
-def read_file_content(file_path):
-    """Read content from various file formats"""
-    try:
-        if file_path.endswith('.txt'):
-            with open(file_path, 'r', encoding='utf-8') as f:
-                return f.read()
-        
-        elif file_path.endswith('.pdf'):
-            content = ""
-            with open(file_path, 'rb') as f:
-                pdf_reader = PyPDF2.PdfReader(f)
-                for page in pdf_reader.pages:
-                    content += page.extract_text() + "\n"
-            return content
-        
-        elif file_path.endswith('.docx'):
-            doc = docx.Document(file_path)
-            content = "\n".join([paragraph.text for paragraph in doc.paragraphs])
-            return content
-        
-        elif file_path.endswith('.json'):
-            with open(file_path, 'r', encoding='utf-8') as f:
-                data = json.load(f)
-                return json.dumps(data, indent=2)
-        
-        elif file_path.endswith('.xlsx'):
-            # Read Excel file
-            content = ""
-            workbook = openpyxl.load_workbook(file_path)
-            
-            for sheet_name in workbook.sheetnames:
-                sheet = workbook[sheet_name]
-                content += f"\n--- Sheet: {sheet_name} ---\n"
-                
-                for row in sheet.iter_rows(values_only=True):
-                    row_content = " | ".join([str(cell) if cell is not None else "" for cell in row])
-                    content += row_content + "\n"
-            
-            return content
-        
-        else:
-            print(f" Unsupported file format: {file_path}")
-            return ""
-    
-    except Exception as e:
-        print(f" Error reading file {file_path}: {e}")
-        return ""
-
 def setup_document_collection(user_id):
     """Setup ChromaDB collection with documents for specific user"""
     print("\n Document Management")
@@ -267,13 +208,18 @@ def setup_document_collection(user_id):
     
     choice = input("Enter choice (1-5): ").strip()
     
-    collection_name = f"user_{user_id}_documents"
-    
     try:
-        collection = chroma_client.get_or_create_collection(
-            name=collection_name,
-            metadata={"user_id": user_id, "created_at": datetime.now().isoformat()}
-        )
+        collection = open_user_collection(chroma_client, user_id)
+        
+        # Skipped while the app is indexing for this user, so chunks it
+        # writes are not mistaken for strays
+        try:
+            if not has_active_jobs(db[JOBS_COLLECTION], user_id):
+                removed = compact_collection(collection, user_id)
+                if removed:
+                    print(f"  Removed {removed} chunks of files that no longer exist.")
+        except Exception as e:
+            print(f"  Could not compact documents: {e}")
         
         if choice == "1":
             uploaded_files = upload_files(user_id)
@@ -315,20 +261,9 @@ def setup_document_collection(user_id):
         elif choice == "4":
             confirm = input("Delete ALL your documents and uploaded files? (y/n): ").strip().lower()
             if confirm == 'y':
-                chroma_client.delete_collection(collection_name)
+                collection = clear_documents(chroma_client, user_id)
                 print("  All your documents cleared from database!")
-                
-                # Delete user-specific upload directory
-                user_uploads_dir = get_user_uploads_dir(user_id)
-                for file_path in user_uploads_dir.glob("*"):
-                    if file_path.is_file():
-                        file_path.unlink()
                 print("  All your uploaded files deleted!")
-                
-                collection = chroma_client.get_or_create_collection(
-                    name=collection_name,
-                    metadata={"user_id": user_id, "cleared_at": datetime.now().isoformat()}
-                )
             return collection
         
         elif choice == "5":
@@ -344,65 +279,36 @@ def setup_document_collection(user_id):
 
 def process_files_to_collection(file_paths, collection, user_id):
     """Process files and add to ChromaDB collection"""
-    documents = []
-    metadatas = []
-    ids = []
+    def show_progress(progress):
+        print(f"\r  Indexed {progress['files_done']}/{progress['files_total']} files "
+              f"({progress['chunks_written']} chunks written)", end="", flush=True)
     
-    for file_path in file_paths:
-        content = read_file_content(file_path)
-        if content:
-            sentences = re.split(r'(?<=[.!?]) +', content)
-            chunks = []
-            current_chunk = ""
-            
-            for sentence in sentences:
-                if len(current_chunk) + len(sentence) < 800:
-                    current_chunk += sentence + " "
-                else:
-                    chunks.append(current_chunk.strip())
-                    current_chunk = sentence + " "
-            
-            if current_chunk:
-                chunks.append(current_chunk.strip())
-            
-            for i, chunk in enumerate(chunks):
-                documents.append(chunk)
-                metadatas.append({
-                    "source": file_path, 
-                    "chunk_index": i,
-                    "user_id": user_id,
-                    "filename": os.path.basename(file_path),
-                    "file_type": os.path.splitext(file_path)[1]
-                })
-                ids.append(f"{user_id}_{os.path.basename(file_path)}_{i}_{uuid.uuid4().hex[:6]}")
+    stats = index_files(file_paths, collection, user_id, progress=show_progress)
+    print()
     
-    if documents:
-        collection.add(
-            documents=documents,
-            metadatas=metadatas,
-            ids=ids
-        )
-        print(f"  Added {len(documents)} document chunks from {len(file_paths)} files!")
-        print(f"  Total documents in your collection: {collection.count()}")
-    else:
+    if stats["indexed"]:
+        print(f"  Added {stats['added']} document chunks from {stats['indexed']} files!")
+        if stats["removed"]:
+            print(f"  Removed {stats['removed']} stale chunks from changed files.")
+    if stats["skipped"]:
+        print(f"  Skipped {stats['skipped']} unchanged files (already indexed).")
+    for file_path, error in stats["errors"]:
+        print(f" Error reading file {file_path}: {error}")
+    if not stats["indexed"] and not stats["skipped"] and not stats["errors"]:
         print("  No valid content found in provided files!")
+    print(f"  Total documents in your collection: {collection.count()}")
     
     return collection
 
 def query_documents(question, collection, n_results=3):
     """Query documents using ChromaDB"""
     try:
-        results = collection.query(
-            query_texts=[question],
-            n_results=n_results
-        )
+        results = search_documents(question, collection, n_results)
         
         if results and results['documents'] and results['documents'][0]:
-            relevant_content = "\n\n".join([
-                f" Source: {results['metadatas'][0][i].get('filename', 'Unknown')}\n"
-                f"Content: {doc}\n"
-                for i, doc in enumerate(results['documents'][0])
-            ])
+            relevant_content = build_document_context(
+                list(zip(results['ids'][0], results['documents'][0], results['metadatas'][0]))
+            )
             return relevant_content
         else:
             return "  No relevant information found in your documents."
@@ -412,7 +318,7 @@ def query_documents(question, collection, n_results=3):
         return " Error searching documents."
 
 def list_my_chats(user_id):
-    chats = list(collection.find({"user_id": user_id}).sort("timestamp", -1))
+    chats, _ = list_chat_summaries(collection, user_id, limit=0)
     return chats
 
 def pick_chat_by_index(chats, prompt="Enter chat number: "):
@@ -426,9 +332,16 @@ def pick_chat_by_index(chats, prompt="Enter chat number: "):
         print(" Enter a valid number.")
         return None
 
-def chat_loop(conversation, chat_log, user_id, title=None, mode="global", doc_collection=None):
+def chat_loop(conversation, chat_log, user_id, title=None, mode="global", doc_collection=None,
+              chat_id=None):
     print("\n  Type 'exit' to finish the chat.")
     
+    if title is None:
+        title = f"Chat_{datetime.now().strftime('%Y%m%d_%H%M%S')}"
+    # Messages already in MongoDB (a continued chat); only later ones are written
+    saved_count = len(chat_log) if chat_id is not None else 0
+    summary_state = new_summary_state()
+    
     while True:
         user_input = input("🧑 You: ").strip()
         if user_input.lower() in ["exit", "quit"]:
@@ -457,22 +370,29 @@ If the document doesn't contain the exact answer, say "I don't have information
             
             chat_log.append({"role": "user", "content": user_input})
             
+            print("🤖 Assistant (from your documents): ", end="", flush=True)
+            answer = ""
             try:
-                response = client.chat.completions.create(
-                    messages=local_conversation,
-                    model="jamba-large",
+                for delta in stream_chat(
+                    local_conversation,
                     max_tokens=300,
                     temperature=0.1,
                     top_p=0.9
-                )
-                answer = response.choices[0].message.content
-                print("🤖 Assistant (from your documents):", answer)
+                ):
+                    answer += delta
+                    print(delta, end="", flush=True)
+                print()
                 conversation.append(ChatMessage(role="user", content=user_input))
                 conversation.append(ChatMessage(role="assistant", content=answer))
                 chat_log.append({"role": "assistant", "content": answer})
             except Exception as e:
-                print(" AI21 API error:", e)
-                if relevant_doc_content and "No relevant information" not in relevant_doc_content:
+                print("\n AI21 API error:", e)
+                if answer:
+                    # Keep whatever streamed before the failure
+                    conversation.append(ChatMessage(role="user", content=user_input))
+                    conversation.append(ChatMessage(role="assistant", content=answer))
+                    chat_log.append({"role": "assistant", "content": answer})
+                elif relevant_doc_content and "No relevant information" not in relevant_doc_content:
                     print(" Most relevant document content:", relevant_doc_content[:500] + "...")
                     conversation.append(ChatMessage(role="user", content=user_input))
                     conversation.append(ChatMessage(role="assistant", content=relevant_doc_content))
@@ -481,31 +401,38 @@ If the document doesn't contain the exact answer, say "I don't have information
         else:
             conversation.append(ChatMessage(role="user", content=user_input))
             chat_log.append({"role": "user", "content": user_input})
+            print("🤖 Assistant: ", end="", flush=True)
+            answer = ""
             try:
-                response = client.chat.completions.create(
-                    messages=conversation,
-                    model="jamba-large",
+                context = build_context(
+                    chat_log,
+                    summary_state,
+                    summarize_conversation
+                )
+                for delta in stream_chat(
+                    [ChatMessage(role=msg["role"], content=msg["content"]) for msg in context],
                     max_tokens=250,
                     temperature=0.3,
                     top_p=0.9
-                )
-                answer = response.choices[0].message.content
-                print("🤖 Assistant:", answer)
+                ):
+                    answer += delta
+                    print(delta, end="", flush=True)
+                print()
+            except Exception as e:
+                print("\n AI21 API error:", e)
+            if answer:
                 conversation.append(ChatMessage(role="assistant", content=answer))
                 chat_log.append({"role": "assistant", "content": answer})
-            except Exception as e:
-                print(" AI21 API error:", e)
-
-    if title is None:
-        title = f"Chat_{datetime.now().strftime('%Y%m%d_%H%M%S')}"
-
-    collection.insert_one({
-        "user_id": user_id,
-        "title": title,
-        "chat": chat_log,
-        "timestamp": datetime.now(),
-        "mode": mode
-    })
+        
+        if chat_log and chat_log[-1]["role"] == "assistant":
+            chat_id, saved_count = save_new_messages(
+                collection, chat_id, user_id, title, mode, chat_log, saved_count
+            )
+
+    chat_id, saved_count = save_new_messages(
+        collection, chat_id, user_id, title, mode, chat_log, saved_count
+    )
+    flush_chat_writes()
     print("  Chat saved to MongoDB!\n")
 
 # ===== MAIN =====
@@ -562,6 +489,7 @@ while True:
             conversation = []
             chat_log = []
             print("\n Previous messages:")
+            chosen = load_chat(collection, chosen["_id"], user_id) or chosen
             for msg in chosen.get("chat", []):
                 emoji = "🧑" if msg['role']=="user" else "🤖"
                 print(f"{emoji} {msg['content']}")
@@ -571,7 +499,7 @@ while True:
             chat_mode = chosen.get("mode", "global")
             current_doc_collection = doc_collection if chat_mode == "local" else None
             chat_loop(conversation, chat_log, user_id, title=chosen.get("title", "Untitled"), 
-                     mode=chat_mode, doc_collection=current_doc_collection)
+                     mode=chat_mode, doc_collection=current_doc_collection, chat_id=chosen["_id"])
 
         elif choice == "2":
             conversation = []
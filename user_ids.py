@@ -0,0 +1,122 @@
+import os
+import logging
+import threading
+from datetime import datetime
+
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError, OperationFailure
+
+COUNTERS_COLLECTION = "counters"
+USER_ID_COUNTER = "user_id"
+USER_ID_PREFIX = "USR"
+USER_ID_BLOCK_SIZE = int(os.getenv("USER_ID_BLOCK_SIZE", 1))
+INSERT_ATTEMPTS = 3
+
+logger = logging.getLogger(__name__)
+
+_allocators = {}
+_allocators_lock = threading.Lock()
+_indexed_user_collections = set()
+
+def format_user_id(number):
+    return f"{USER_ID_PREFIX}{number:04d}"
+
+def ensure_user_indexes(users_collection):
+    """Unique indexes that make duplicate IDs and emails impossible.
+    
+    Runs once per process per collection. If existing data already holds
+    duplicates the index cannot be built; that is logged and registration
+    keeps working without the guarantee.
+    """
+    if users_collection.full_name in _indexed_user_collections:
+        return
+    _indexed_user_collections.add(users_collection.full_name)
+    for field in ("user_id", "email"):
+        try:
+            users_collection.create_index(field, unique=True)
+        except OperationFailure as e:
+            logger.warning("Could not create unique index on users.%s: %s", field, e)
+
+class UserIdAllocator:
+    """Hands out user IDs from an atomic counter document.
+    
+    Each reservation is one ``find_one_and_update`` with ``$inc``, so
+    concurrent registrations in any number of processes never share an
+    ID and no query over the users collection is needed. With
+    ``block_size`` > 1 a process reserves that many numbers at once and
+    serves them from memory; numbers left unused at exit are skipped.
+    """
+    
+    def __init__(self, users_collection, block_size=USER_ID_BLOCK_SIZE):
+        self.users = users_collection
+        self.counters = users_collection.database[COUNTERS_COLLECTION]
+        self.block_size = max(1, block_size)
+        self._next = 1
+        self._end = 0
+        self._seeded = False
+        self._lock = threading.Lock()
+    
+    def _seed(self):
+        """Start the counter at the highest existing ID the first time it is used"""
+        highest = 0
+        for user in self.users.find({"user_id": {"$regex": f"^{USER_ID_PREFIX}\\d+$"}}, {"user_id": 1, "_id": 0}):
+            highest = max(highest, int(user["user_id"][len(USER_ID_PREFIX):]))
+        # $max never lowers the counter, so racing seeders are harmless
+        self.counters.update_one(
+            {"_id": USER_ID_COUNTER}, {"$max": {"seq": highest}}, upsert=True
+        )
+    
+    def allocate(self):
+        with self._lock:
+            if self._next > self._end:
+                if not self._seeded:
+                    if self.counters.find_one({"_id": USER_ID_COUNTER}) is None:
+                        self._seed()
+                    self._seeded = True
+                counter = self.counters.find_one_and_update(
+                    {"_id": USER_ID_COUNTER},
+                    {"$inc": {"seq": self.block_size}},
+                    upsert=True,
+                    return_document=ReturnDocument.AFTER
+                )
+                self._end = counter["seq"]
+                self._next = self._end - self.block_size + 1
+            number = self._next
+            self._next += 1
+        return format_user_id(number)
+
+def generate_user_id(users_collection):
+    """Allocate a new, unique user ID"""
+    key = users_collection.full_name
+    with _allocators_lock:
+        allocator = _allocators.get(key)
+        if allocator is None:
+            allocator = _allocators[key] = UserIdAllocator(users_collection)
+    return allocator.allocate()
+
+def _is_duplicate_email(error):
+    key_pattern = (error.details or {}).get("keyPattern") or {}
+    return "email" in key_pattern or "email" in str(error)
+
+def insert_user(users_collection, username, email, generate_user_id=generate_user_id):
+    """Create a user record and return its ID, or None if the email is taken.
+    
+    The unique indexes settle races between concurrent registrations: a
+    clash on email means the account already exists, a clash on user_id
+    (e.g. a counter reset by hand) is retried with a fresh ID.
+    """
+    for attempt in range(INSERT_ATTEMPTS):
+        user_id = generate_user_id(users_collection)
+        try:
+            users_collection.insert_one({
+                "user_id": user_id,
+                "username": username,
+                "email": email,
+                "created_at": datetime.now()
+            })
+            return user_id
+        except DuplicateKeyError as e:
+            if _is_duplicate_email(e):
+                return None
+            if attempt == INSERT_ATTEMPTS - 1:
+                raise
\ No newline at end of file
@@ -0,0 +1,50 @@
+import os
+
+from cache import TTLCache
+
+PROFILE_CACHE_SIZE = int(os.getenv("PROFILE_CACHE_SIZE", 1024))
+PROFILE_CACHE_TTL = int(os.getenv("PROFILE_CACHE_TTL", 300))
+PROFILE_FIELDS = {"_id": 0, "user_id": 1, "username": 1, "email": 1, "last_mode": 1}
+
+_profiles = TTLCache(PROFILE_CACHE_SIZE, PROFILE_CACHE_TTL)
+
+def get_profile(users_collection, user_id):
+    """Return a user's profile, from the process-wide cache when possible.
+
+    Only the fields in PROFILE_FIELDS are fetched, through the unique
+    ``user_id`` index. Missing users are not cached.
+    """
+    profile = _profiles.get(user_id)
+    if profile is None:
+        profile = users_collection.find_one({"user_id": user_id}, PROFILE_FIELDS)
+        if profile is not None:
+            _profiles.set(user_id, profile)
+    return profile
+
+def find_login_profile(users_collection, email, user_id):
+    """Return the profile matching both email and user ID, or None.
+
+    A cached profile answers without a database round trip; otherwise the
+    lookup goes through the unique ``user_id`` index and primes the cache
+    for the sidebar.
+    """
+    profile = _profiles.get(user_id)
+    if profile is not None:
+        return profile if profile.get("email") == email else None
+    profile = users_collection.find_one({"email": email, "user_id": user_id}, PROFILE_FIELDS)
+    if profile is not None:
+        _profiles.set(user_id, profile)
+    return profile
+
+def invalidate_profile(user_id):
+    """Forget a cached profile; call after changing a user's record"""
+    _profiles.pop(user_id)
+
+
+def remember_mode(users_collection, user_id, mode):
+    """Record the chat mode a user last picked, writing only when it changed"""
+    profile = get_profile(users_collection, user_id)
+    if profile is not None and profile.get("last_mode") == mode:
+        return
+    users_collection.update_one({"user_id": user_id}, {"$set": {"last_mode": mode}})
+    invalidate_profile(user_id)
\ No newline at end of file
@@ -238,13 +238,5 @@ def inject_custom_css():
     </style>
     """, unsafe_allow_html=True)
 
-def generate_user_id(users_collection):
-    last_user = users_collection.find_one(sort=[("created_at", -1)])
-    if not last_user:
-        return "USR0001"
-    last_id = last_user["user_id"]
-    last_num = int(last_id[3:])
-    return f"USR{last_num+1:04d}"
-
 def is_valid_email(email):
     return re.match(r"^[\w\.-]+@[\w\.-]+\.\w+$", email)
\ No newline at end of file
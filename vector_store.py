@@ -0,0 +1,205 @@
+import os
+import sys
+import hashlib
+import threading
+from datetime import datetime
+
+from cache import TTLCache
+from resources import get_embedding_function
+
+VECTOR_STORE_MODE = os.getenv("VECTOR_STORE_MODE", "per_user")
+VECTOR_STORE_SHARDS = int(os.getenv("VECTOR_STORE_SHARDS", 16))
+SHARD_PREFIX = "shared_documents"
+MIGRATION_BATCH_SIZE = int(os.getenv("MIGRATION_BATCH_SIZE", 500))
+COLLECTION_POOL_SIZE = int(os.getenv("COLLECTION_POOL_SIZE", 256))
+COLLECTION_POOL_IDLE_SECONDS = int(os.getenv("COLLECTION_POOL_IDLE_SECONDS", 1800))
+
+_pool = TTLCache(COLLECTION_POOL_SIZE, COLLECTION_POOL_IDLE_SECONDS)
+
+def user_collection_name(user_id):
+    """Per-user collection name; also the logical name caches and BM25 key on"""
+    return f"user_{user_id}_documents"
+
+def shard_name(user_id, shards=VECTOR_STORE_SHARDS):
+    """Shared collection holding a user's chunks.
+    
+    Users are spread by a hash of their ID, so the shard count must not
+    change once data has been written.
+    """
+    shard = int(hashlib.sha256(user_id.encode("utf-8")).hexdigest()[:8], 16) % shards
+    return f"{SHARD_PREFIX}_{shard:03d}"
+
+class TenantCollection:
+    """One user's view of a shared, sharded Chroma collection.
+    
+    Quacks like the Chroma collection the rest of the app expects: every
+    read, query and delete is restricted with a ``user_id`` where-filter,
+    every write is stamped with ``user_id``, and chunk IDs are prefixed
+    with the user ID in the shard so identical chunks of two users never
+    collide. ``name`` is the per-user logical name, so query caches and
+    the BM25 index stay per user.
+    """
+    
+    def __init__(self, collection, user_id):
+        self.collection = collection
+        self.user_id = user_id
+        self.name = user_collection_name(user_id)
+        self._prefix = f"{user_id}:"
+    
+    def _where(self, where=None):
+        if not where:
+            return {"user_id": self.user_id}
+        return {"$and": [{"user_id": self.user_id}, where]}
+    
+    def _ids(self, ids):
+        return [self._prefix + chunk_id for chunk_id in ids]
+    
+    def _strip(self, chunk_id):
+        return chunk_id[len(self._prefix):] if chunk_id.startswith(self._prefix) else chunk_id
+    
+    def _metadatas(self, metadatas):
+        return [dict(metadata or {}, user_id=self.user_id) for metadata in metadatas]
+    
+    def add(self, ids, documents=None, metadatas=None, embeddings=None):
+        self.collection.add(ids=self._ids(ids), documents=documents,
+                            metadatas=self._metadatas(metadatas or [{}] * len(ids)), embeddings=embeddings)
+    
+    def upsert(self, ids, documents=None, metadatas=None, embeddings=None):
+        self.collection.upsert(ids=self._ids(ids), documents=documents,
+                               metadatas=self._metadatas(metadatas or [{}] * len(ids)), embeddings=embeddings)
+    
+    def update(self, ids, documents=None, metadatas=None, embeddings=None):
+        self.collection.update(ids=self._ids(ids), documents=documents,
+                               metadatas=self._metadatas(metadatas) if metadatas else None,
+                               embeddings=embeddings)
+    
+    def delete(self, ids=None, where=None):
+        self.collection.delete(ids=self._ids(ids) if ids is not None else None, where=self._where(where))
+    
+    def get(self, ids=None, where=None, limit=None, offset=None, include=None):
+        kwargs = {} if include is None else {"include": include}
+        results = self.collection.get(ids=self._ids(ids) if ids is not None else None,
+                                      where=self._where(where), limit=limit, offset=offset, **kwargs)
+        results["ids"] = [self._strip(chunk_id) for chunk_id in results["ids"]]
+        return results
+    
+    def query(self, query_texts=None, n_results=10, where=None, include=None, query_embeddings=None):
+        kwargs = {} if include is None else {"include": include}
+        results = self.collection.query(query_texts=query_texts, query_embeddings=query_embeddings,
+                                        n_results=n_results, where=self._where(where), **kwargs)
+        results["ids"] = [[self._strip(chunk_id) for chunk_id in ids] for ids in results["ids"]]
+        return results
+    
+    def count(self):
+        return len(self.collection.get(where=self._where(), include=[])["ids"])
+
+def get_pooled_collection(chroma_client, name, metadata=None):
+    """Return a handle for collection ``name`` from the process-wide pool.
+
+    Handles are shared by every session and evicted least-recently-used,
+    or after COLLECTION_POOL_IDLE_SECONDS without use. A missing handle
+    is opened with ``get_collection`` so an existing collection's
+    metadata is never rewritten; ``metadata`` only applies when the
+    collection has to be created.
+    """
+    entry = _pool.get(name)
+    if entry is not None and entry[0] is chroma_client:
+        collection = entry[1]
+    else:
+        try:
+            collection = chroma_client.get_collection(name=name, embedding_function=get_embedding_function())
+        except ValueError:
+            collection = chroma_client.get_or_create_collection(
+                name=name, metadata=metadata, embedding_function=get_embedding_function()
+            )
+    # Re-set on every use so the idle timer restarts
+    _pool.set(name, (chroma_client, collection))
+    return collection
+
+def forget_collection(name):
+    """Drop a pooled handle, e.g. after its collection was deleted"""
+    _pool.pop(name)
+
+def _get_shard(chroma_client, user_id):
+    return get_pooled_collection(chroma_client, shard_name(user_id))
+
+def open_user_collection(chroma_client, user_id, mode=None):
+    """Return the collection to store and search a user's documents in"""
+    if (mode or VECTOR_STORE_MODE) == "shared":
+        return TenantCollection(_get_shard(chroma_client, user_id), user_id)
+    return get_pooled_collection(
+        chroma_client, user_collection_name(user_id),
+        metadata={"user_id": user_id, "created_at": datetime.now().isoformat()}
+    )
+
+def warm_user_collection(chroma_client, user_id):
+    """Open a user's collection into the pool in the background"""
+    def warm():
+        try:
+            open_user_collection(chroma_client, user_id)
+        except Exception:
+            pass  # The first real use opens it again and reports errors
+    threading.Thread(target=warm, name="collection-warmup", daemon=True).start()
+
+def delete_user_documents(chroma_client, user_id, mode=None):
+    """Remove every stored chunk of a user's documents"""
+    if (mode or VECTOR_STORE_MODE) == "shared":
+        _get_shard(chroma_client, user_id).delete(where={"user_id": user_id})
+        return
+    forget_collection(user_collection_name(user_id))
+    try:
+        chroma_client.delete_collection(user_collection_name(user_id))
+    except ValueError:
+        pass  # Nothing indexed yet
+
+def migrate_user_to_shared(chroma_client, user_id, batch_size=MIGRATION_BATCH_SIZE, delete_source=False):
+    """Copy a per-user collection into its shard; returns the chunks copied.
+    
+    Stored embeddings are copied as-is, so nothing is re-encoded. Chunk
+    IDs (and with them the BM25 index and ingestion manifests) are
+    unchanged from the user's point of view. The source collection is
+    only deleted when asked to and the shard holds every chunk.
+    """
+    try:
+        source = chroma_client.get_collection(user_collection_name(user_id))
+    except ValueError:
+        return 0
+    target = open_user_collection(chroma_client, user_id, mode="shared")
+    
+    copied = 0
+    offset = 0
+    while True:
+        page = source.get(include=["documents", "metadatas", "embeddings"], limit=batch_size, offset=offset)
+        if not page["ids"]:
+            break
+        target.upsert(ids=page["ids"], documents=page["documents"],
+                      metadatas=page["metadatas"], embeddings=page["embeddings"])
+        copied += len(page["ids"])
+        offset += len(page["ids"])
+    
+    if delete_source and target.count() >= source.count():
+        forget_collection(source.name)
+        chroma_client.delete_collection(source.name)
+    return copied
+
+def migrate_all_to_shared(chroma_client, delete_source=False):
+    """Migrate every per-user collection; returns ``{user_id: chunks}``"""
+    prefix, suffix = "user_", "_documents"
+    migrated = {}
+    for collection in chroma_client.list_collections():
+        name = collection.name
+        if name.startswith(prefix) and name.endswith(suffix):
+            user_id = name[len(prefix):-len(suffix)]
+            migrated[user_id] = migrate_user_to_shared(chroma_client, user_id, delete_source=delete_source)
+            print(f"  {user_id}: {migrated[user_id]} chunks -> {shard_name(user_id)}")
+    return migrated
+
+if __name__ == "__main__":
+    # python vector_store.py [--delete-source]
+    from dotenv import load_dotenv
+    from resources import get_chroma_client
+    
+    load_dotenv()
+    migrated = migrate_all_to_shared(get_chroma_client(), delete_source="--delete-source" in sys.argv)
+    print(f"Migrated {sum(migrated.values())} chunks for {len(migrated)} users "
+          f"into {VECTOR_STORE_SHARDS} shards. Set VECTOR_STORE_MODE=shared to use them.")
\ No newline at end of file